@@ -1,6 +1,9 @@
-from sqlalchemy import select
+from sqlalchemy import select, exists, update, case
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.postgresql import insert
 import uuid
-from typing import Dict, List, Tuple
+from typing import Dict, List, Tuple, Type
+from pydantic import BaseModel
 from fastapi import HTTPException
 
 from schemas import (
@@ -11,32 +14,37 @@ from schemas import (
 )
 import models
 from config import config
+from database import save
+from audio import audio_cache, read_audio, read_audio_batch, write_audio
+from view_counters import view_buffer
 import random
 
 from CRUD.Object import CRUDObject, check_related_object
+from CRUD.Profiles import profile_options
 
 
 async def retrieve_audio_data(answer: models.Answer) -> bytes:
     # retrieve the audio data
-    audio_data = None
-    with open(f"{config.AUDIO_FILE_PATH}{answer.audio_location}", "rb") as f:
-        audio_data = f.read()
-    return audio_data
+    return await read_audio(answer.audio_location)
 
 
+# 'model' is the pydantic model to build, it must only use relations loaded on the answers
 async def add_audio_and_check_pydantic(
-    answers: List[models.Answer], as_pydantic: bool
-) -> List[Tuple[models.Answer, bytes]] | List[AnswerExternalModel]:
-    # retrieve the audio data
-    answers_audio_data = []
-    for answer in answers:
-        audio_data = await retrieve_audio_data(answer)
-        answers_audio_data.append((answer, audio_data))
+    answers: List[models.Answer],
+    as_pydantic: bool,
+    with_audio: bool = True,
+    model: Type[BaseModel] = AnswerExternalModel,
+) -> List[Tuple[models.Answer, bytes]] | List[BaseModel]:
+    # retrieve the audio data concurrently, unless the client streams it separately
+    answers_audio_data = [(answer, None) for answer in answers]
+    if with_audio:
+        reads = await read_audio_batch([answer.audio_location for answer in answers])
+        answers_audio_data = [
+            (answer, read.audio_data) for answer, read in zip(answers, reads)
+        ]
     if as_pydantic:
         return [
-            AnswerExternalModel.model_validate(
-                {**answer.__dict__, "audio_data": audio_data}
-            )
+            model.model_validate({**answer.__dict__, "audio_data": audio_data})
             for answer, audio_data in answers_audio_data
         ]
     return answers_audio_data
@@ -45,14 +53,22 @@ async def add_audio_and_check_pydantic(
 # Needs a custom Create to handle creation of related objects
 class CRUDAnswer(CRUDObject):
     # Depending on 'as_pydantic', return either a tuple of (Answer, audio_data) or a pydantic model
+    # With 'with_audio' False, audio_data is None and the audio has to be streamed separately
     async def get(
-        self, id: uuid.UUID, as_pydantic=True, query_dict: Dict = None
-    ) -> Tuple[models.Answer, bytes] | AnswerExternalModel:
-        answer = await super().get(id, query_dict)
+        self,
+        id: uuid.UUID,
+        as_pydantic=True,
+        query_dict: Dict = None,
+        with_audio=True,
+        profile: str = None,
+    ) -> Tuple[models.Answer, bytes] | AnswerExternalModel | None:
+        answer = await super().get(id, query_dict, profile=profile)
+        if answer is None:
+            return None
         # retrieve the audio data
         audio_data = None
-        with open(f"{config.AUDIO_FILE_PATH}{answer.audio_location}", "rb") as f:
-            audio_data = f.read()
+        if with_audio:
+            audio_data = await retrieve_audio_data(answer)
         if as_pydantic:
             # Build external model from answer and audio_data
             return AnswerExternalModel.model_validate(
@@ -60,8 +76,41 @@ class CRUDAnswer(CRUDObject):
             )
         return answer, audio_data
 
+    def _filter(
+        self,
+        stmt,
+        exclude_ids: List[uuid.UUID] = None,
+        exclude_viewed_by: uuid.UUID = None,
+        **kwargs,
+    ):
+        # Filtering happens in the query, so limit applies to the answers actually returned
+        if exclude_ids:
+            stmt = stmt.where(self.model.id.notin_(exclude_ids))
+        if exclude_viewed_by is not None:
+            # Anti-join against the user's views, served by the (user_id, answer_id) primary key
+            stmt = stmt.where(
+                ~exists().where(
+                    models.user_answer_views.c.answer_id == self.model.id,
+                    models.user_answer_views.c.user_id == exclude_viewed_by,
+                )
+            )
+        for key, value in kwargs.items():
+            if isinstance(value, list):
+                stmt = stmt.where(getattr(self.model, key).in_(value))
+            else:
+                stmt = stmt.where(getattr(self.model, key) == value)
+        return stmt
+
     async def get_multi_top(
-        self, skip: int = 0, limit: int = 100, as_pydantic=True, **kwargs
+        self,
+        skip: int = 0,
+        limit: int = 100,
+        as_pydantic=True,
+        with_audio=True,
+        exclude_ids: List[uuid.UUID] = None,
+        exclude_viewed_by: uuid.UUID = None,
+        profile: str = None,
+        **kwargs,
     ) -> List[Tuple[models.Answer, bytes]] | List[AnswerExternalModel]:
         stmt = (
             select(models.Answer)
@@ -74,19 +123,23 @@ class CRUDAnswer(CRUDObject):
             )
             .limit(limit)
             .offset(skip)
+            .options(*profile_options(self.model, profile))
         )
-        if kwargs:
-            for key, value in kwargs.items():
-                if isinstance(value, list):
-                    stmt = stmt.where(getattr(self.model, key).in_(value))
-                else:
-                    stmt = stmt.where(getattr(self.model, key) == value)
+        stmt = self._filter(stmt, exclude_ids, exclude_viewed_by, **kwargs)
         result = await self.db.execute(stmt)
         answers = result.unique().scalars().all()
-        return await add_audio_and_check_pydantic(answers, as_pydantic)
+        return await add_audio_and_check_pydantic(answers, as_pydantic, with_audio)
 
     async def get_multi_least_viewed(
-        self, skip: int = 0, limit: int = 100, as_pydantic=True, **kwargs
+        self,
+        skip: int = 0,
+        limit: int = 100,
+        as_pydantic=True,
+        with_audio=True,
+        exclude_ids: List[uuid.UUID] = None,
+        exclude_viewed_by: uuid.UUID = None,
+        profile: str = None,
+        **kwargs,
     ) -> List[Tuple[models.Answer, bytes]] | List[AnswerExternalModel]:
         stmt = (
             select(models.Answer)
@@ -94,31 +147,54 @@ class CRUDAnswer(CRUDObject):
             .order_by(models.Answer.unique_views)
             .limit(limit)
             .offset(skip)
+            .options(*profile_options(self.model, profile))
         )
-        if kwargs:
-            for key, value in kwargs.items():
-                if isinstance(value, list):
-                    stmt = stmt.where(getattr(self.model, key).in_(value))
-                else:
-                    stmt = stmt.where(getattr(self.model, key) == value)
+        stmt = self._filter(stmt, exclude_ids, exclude_viewed_by, **kwargs)
         result = await self.db.execute(stmt)
         answers = result.unique().scalars().all()
-        return await add_audio_and_check_pydantic(answers, as_pydantic)
+        return await add_audio_and_check_pydantic(answers, as_pydantic, with_audio)
 
     async def get_multi_unset(
-        self, skip: int = 0, limit: int = 100, as_pydantic=True, **kwargs
+        self,
+        skip: int = 0,
+        limit: int = 100,
+        as_pydantic=True,
+        with_audio=True,
+        exclude_ids: List[uuid.UUID] = None,
+        exclude_viewed_by: uuid.UUID = None,
+        profile: str = None,
+        **kwargs,
     ) -> List[Tuple[models.Answer, bytes]] | List[AnswerExternalModel]:
         # Choose randomly between the two
         if random.choice([True, False]):
-            return await self.get_multi_top(skip, limit, as_pydantic, **kwargs)
-        return await self.get_multi_least_viewed(skip, limit, as_pydantic, **kwargs)
+            return await self.get_multi_top(
+                skip,
+                limit,
+                as_pydantic,
+                with_audio,
+                exclude_ids=exclude_ids,
+                exclude_viewed_by=exclude_viewed_by,
+                profile=profile,
+                **kwargs,
+            )
+        return await self.get_multi_least_viewed(
+            skip,
+            limit,
+            as_pydantic,
+            with_audio,
+            exclude_ids=exclude_ids,
+            exclude_viewed_by=exclude_viewed_by,
+            profile=profile,
+            **kwargs,
+        )
 
     async def get_multi(
-        self, skip: int = 0, limit: int = 100, as_pydantic=True, **kwargs
+        self, skip: int = 0, limit: int = 100, as_pydantic=True, profile: str = "answer", **kwargs
     ) -> List[Tuple[models.Answer, bytes]] | List[AnswerExternalModel]:
         stmt = (
             select(models.Answer)
             .where(self.model.is_active == True)
+            .options(*profile_options(self.model, profile))
             .limit(limit)
             .offset(skip)
         )
@@ -130,21 +206,7 @@ class CRUDAnswer(CRUDObject):
                     stmt = stmt.where(getattr(self.model, key) == value)
         result = await self.db.execute(stmt)
         answers = result.unique().scalars().all()
-        # retrieve the audio data
-        answers_audio_data = []
-        for answer in answers:
-            audio_data = None
-            with open(f"{config.AUDIO_FILE_PATH}{answer.audio_location}", "rb") as f:
-                audio_data = f.read()
-            answers_audio_data.append((answer, audio_data))
-        if as_pydantic:
-            return [
-                AnswerExternalModel.model_validate(
-                    {**answer.__dict__, "audio_data": audio_data}
-                )
-                for answer, audio_data in answers_audio_data
-            ]
-        return answers_audio_data
+        return await add_audio_and_check_pydantic(answers, as_pydantic)
 
     async def create(
         self,
@@ -159,8 +221,7 @@ class CRUDAnswer(CRUDObject):
         # Save the audio data to audio_files, provided as bytes
         audio_data = answer_in.audio_data
         audio_location = uuid.uuid4()
-        with open(f"{config.AUDIO_FILE_PATH}{audio_location}", "wb") as f:
-            f.write(audio_data)
+        await write_audio(audio_location, audio_data)
         # Create the answer
         obj_in_data = answer_in.model_dump()
         answer = models.Answer(
@@ -174,9 +235,13 @@ class CRUDAnswer(CRUDObject):
         answer.audio_location = audio_location
         answer.author = user
         answer.question = question
+        # A new answer has none, so they aren't loaded after the insert
+        answer.viewed_by = []
+        answer.votes = []
+        answer.flags = []
+        answer.embeddings = []
         self.db.add(answer)
-        await self.db.commit()
-        await self.db.refresh(answer)
+        await save(self.db, answer)
         if as_pydantic:
             # Build external model from answer and audio_data
             return AnswerExternalModel.model_validate(
@@ -196,14 +261,13 @@ class CRUDAnswer(CRUDObject):
             answer_in, models.Question, "question_id", self.db
         )
         # Save the audio data to audio_files, provided as bytes
-        audio_data = None
-        for field in answer_in.__dict__:
-            if field == "audio_data":
-                audio_data = answer_in.audio_data
-                audio_location = uuid.uuid4()
-                with open(f"{config.AUDIO_FILE_PATH}{audio_location}", "wb") as f:
-                    f.write(audio_data)
-                answer_in.audio_location = audio_location
+        audio_location = answer.audio_location
+        if answer_in.audio_data is not None:
+            audio_location = uuid.uuid4()
+            await write_audio(audio_location, answer_in.audio_data)
+            answer_in.audio_location = audio_location
+            # The previous file is no longer served
+            audio_cache.invalidate(answer.audio_location)
         # Update the answer
         for key in answer_in.model_dump():
             setattr(answer, key, getattr(answer_in, key))
@@ -212,12 +276,9 @@ class CRUDAnswer(CRUDObject):
         answer.question = question
         answer.audio_location = audio_location
 
-        await self.db.commit()
-        await self.db.refresh(answer)
+        await save(self.db, answer)
         # retrieve the audio data
-        audio_data = None
-        with open(f"{config.AUDIO_FILE_PATH}{answer.audio_location}", "rb") as f:
-            audio_data = f.read()
+        audio_data = await retrieve_audio_data(answer)
         if as_pydantic:
             # Build external model from answer and audio_data
             return AnswerExternalModel.model_validate(
@@ -225,19 +286,75 @@ class CRUDAnswer(CRUDObject):
             )
         return answer, audio_data
 
+    async def record_views(
+        self, user_id: uuid.UUID, answer_ids: List[uuid.UUID], commit=True
+    ) -> Dict[uuid.UUID, Tuple[int, int]]:
+        """
+        Records a view by the user on each of the answers in a single statement.
+        Returns the new (views_count, unique_views) of each answer, or nothing when
+        the counters are written behind by view_buffer.
+        """
+        if not answer_ids:
+            return {}
+        if view_buffer.running:
+            return await self._record_views_buffered(user_id, answer_ids, commit)
+        # First views are the rows that didn't exist yet in user_answer_views
+        new_views = (
+            insert(models.user_answer_views)
+            .values([{"user_id": user_id, "answer_id": id} for id in answer_ids])
+            .on_conflict_do_nothing()
+            .returning(models.user_answer_views.c.answer_id)
+            .cte("new_views")
+        )
+        answers = models.Answer.__table__
+        stmt = (
+            update(answers)
+            .where(answers.c.id.in_(answer_ids))
+            .values(
+                views_count=answers.c.views_count + 1,
+                unique_views=answers.c.unique_views
+                + case((answers.c.id.in_(select(new_views.c.answer_id)), 1), else_=0),
+            )
+            .returning(answers.c.id, answers.c.views_count, answers.c.unique_views)
+        )
+        result = await self.db.execute(stmt)
+        counts = {row.id: (row.views_count, row.unique_views) for row in result}
+        if commit:
+            await save(self.db)
+        return counts
+
+    async def _record_views_buffered(
+        self, user_id: uuid.UUID, answer_ids: List[uuid.UUID], commit=True
+    ) -> Dict[uuid.UUID, Tuple[int, int]]:
+        # Only user_answer_views is written now, it decides which views are unique
+        stmt = (
+            insert(models.user_answer_views)
+            .values([{"user_id": user_id, "answer_id": id} for id in answer_ids])
+            .on_conflict_do_nothing()
+            .returning(models.user_answer_views.c.answer_id)
+        )
+        result = await self.db.execute(stmt)
+        new_views = set(result.scalars().all())
+        # Buffered once the views are committed, here or by the caller
+        for answer_id in answer_ids:
+            view_buffer.add_after_commit(self.db, answer_id, 1, 1 if answer_id in new_views else 0)
+        if commit:
+            await save(self.db)
+        return {}
+
     async def view(
-        self, answer: AnswerUpdateModel, user: models.User, as_pydantic=True
+        self, answer: AnswerUpdateModel, user: models.User, as_pydantic=True, with_audio=True
     ) -> Tuple[models.Answer, bytes] | AnswerExternalModel:
         # Update the answer with one view more
-        answer_model = await self.get(id=answer.id, as_pydantic=False)
-        answer_model = answer_model[0]
-        answer_model.views_count += 1
-        if user not in answer_model.viewed_by:
-            answer_model.viewed_by.append(user)
-            answer_model.unique_views += 1
-        await self.db.commit()
-        await self.db.refresh(answer_model)
-        answer, audio_data = await self.get(id=answer.id, as_pydantic=False)
+        views = await self.record_views(user.id, [answer.id])
+        answer_model, audio_data = await self.get(
+            id=answer.id, as_pydantic=False, with_audio=with_audio, profile="answer"
+        )
+        if answer.id in views:
+            # The answer may already be in the session, with the counters before the view
+            views_count, unique_views = views[answer.id]
+            set_committed_value(answer_model, "views_count", views_count)
+            set_committed_value(answer_model, "unique_views", unique_views)
         if as_pydantic:
             # Build external model from answer and audio_data
             return AnswerExternalModel.model_validate(
@@ -248,7 +365,7 @@ class CRUDAnswer(CRUDObject):
     async def get_views_multi(
         self, skip: int = 0, limit: int = 100, as_pydantic=True, **kwargs
     ) -> List[models.Answer] | List[AnswerExternalViewsModel]:
-        answers = await super().get_multi(skip, limit, **kwargs)
+        answers = await super().get_multi(skip, limit, profile="views", **kwargs)
         if as_pydantic:
             return [
                 AnswerExternalViewsModel.model_validate(
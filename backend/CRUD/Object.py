@@ -4,11 +4,14 @@
 from typing import List, Type, TypeVar, Dict, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import update, values, column
 from fastapi import HTTPException
 
 import uuid
 
 import models, schemas
+from CRUD.Profiles import profile_options
+from database import save
 
 # Type indicating Question, Answer, Flag, Vote, Embedding but not User
 ModelType = TypeVar("ModelType", models.Question, models.Answer, models.Flag, models.Vote, models.Embedding, models.TopicSubscription)
@@ -39,13 +42,78 @@ async def check_related_object(model, related_model, related_id_field, db: Async
         )
     return related_object
 
+async def increment_counter(model, id: uuid.UUID, counter_field: str, db: AsyncSession, amount: int = 1) -> int | None:
+    """
+    Atomically adds amount to a counter column in the database, without loading the object.
+    Returns the new value, or None if there's no such object.
+    """
+    table = model.__table__
+    counter = table.c[counter_field]
+    stmt = (
+        update(table)
+        .where(table.c.id == id)
+        .values({counter_field: counter + amount})
+        .returning(counter)
+    )
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none()
+
+# Bind parameters allowed in one statement by the Postgres protocol
+MAX_BIND_PARAMS = 32767
+
+async def bulk_update(model, rows: List[Dict], db: AsyncSession) -> List:
+    """
+    Updates objects by id, each with only the fields in its dict, without loading them.
+    Rows setting the same fields are written with a single UPDATE ... FROM (VALUES ...) RETURNING,
+    split to stay under MAX_BIND_PARAMS. Keys that aren't columns are ignored.
+    Returns the updated rows in the order of rows, ids with no object are left out.
+    """
+    table = model.__table__
+    # Repeated ids are merged, later fields win
+    by_id: Dict[uuid.UUID, Dict] = {}
+    for row in rows:
+        by_id.setdefault(row["id"], {}).update(row)
+    groups: Dict[Tuple[str, ...], List[Dict]] = {}
+    for row in by_id.values():
+        fields = tuple(sorted(key for key in row if key != "id" and key in table.c))
+        if fields:
+            groups.setdefault(fields, []).append(row)
+
+    updated = {}
+    for fields, group in groups.items():
+        # One parameter is left for updated_at
+        chunk_size = (MAX_BIND_PARAMS - 1) // (len(fields) + 1)
+        for start in range(0, len(group), chunk_size):
+            new_values = values(
+                column("id", table.c.id.type),
+                *[column(field, table.c[field].type) for field in fields],
+                name="new_values",
+            ).data([
+                (row["id"], *[row[field] for field in fields])
+                for row in group[start:start + chunk_size]
+            ])
+            stmt = (
+                update(table)
+                .where(table.c.id == new_values.c.id)
+                .values({field: new_values.c[field] for field in fields})
+                .returning(*table.c)
+            )
+            result = await db.execute(stmt)
+            for row in result:
+                updated[row.id] = row
+    return [updated[id] for id in by_id if id in updated]
+
 class CRUDObject:
     def __init__(self, db: AsyncSession, model: Type[ModelType]):
         self.db = db
         self.model = model
 
-    async def get(self, id: uuid.UUID = None, query_dict: Dict = None) -> ModelType:
+    async def get(self, id: uuid.UUID = None, query_dict: Dict = None, profile: str = None) -> ModelType:
         stmt = select(self.model).where(self.model.is_active == True)
+        stmt = stmt.options(*profile_options(self.model, profile))
+        if profile is not None:
+            # Load what the profile needs even if the object is already in the session, loaded with another profile
+            stmt = stmt.execution_options(populate_existing=True)
 
         if id is not None:
             stmt = stmt.where(self.model.id == id)
@@ -60,8 +128,9 @@ class CRUDObject:
         obj = result.scalars().first()
         return obj
 
-    async def get_multi(self, skip: int = 0, limit: int = 100, **kwargs) -> List[ModelType]:
+    async def get_multi(self, skip: int = 0, limit: int = 100, profile: str = None, **kwargs) -> List[ModelType]:
         stmt = select(self.model).where(self.model.is_active == True).limit(limit).offset(skip)
+        stmt = stmt.options(*profile_options(self.model, profile))
         if kwargs:
             for key, value in kwargs.items():
                 if isinstance(value, list):
@@ -76,8 +145,7 @@ class CRUDObject:
         obj_in_data = obj_in.model_dump()
         obj = self.model(**obj_in_data)
         self.db.add(obj)
-        await self.db.commit()
-        await self.db.refresh(obj)
+        await save(self.db, obj)
         return obj
     
     async def update(self, obj: ModelType, obj_in: UpdateSchemaType) -> ModelType:
@@ -86,6 +154,5 @@ class CRUDObject:
         for field in obj_data:
             if field in update_data:
                 setattr(obj, field, update_data[field])
-        await self.db.commit()
-        await self.db.refresh(obj)
+        await save(self.db, obj)
         return obj
\ No newline at end of file
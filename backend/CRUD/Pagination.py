@@ -0,0 +1,99 @@
+# Keyset pagination and NDJSON streaming for the admin list endpoints.
+# Rows are ordered by (created_at, id), served by the ix_<table>_created_at_id indexes,
+# so a page costs the same however deep it is. The cursor is the (created_at, id) of the
+# last row of a page, opaque to clients, and the next page starts after it.
+#
+# usage:
+# return await list_response(db, response, query, models.Flag, cursor, limit, stream, to_external)
+import base64
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+from fastapi import HTTPException, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy import tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import config
+from database import session_manager
+
+# Response header with the cursor of the next page, absent on the last page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+ToExternal = Callable[[List], Awaitable[List[BaseModel]]]
+
+
+def encode_cursor(obj) -> str:
+    return base64.urlsafe_b64encode(f"{obj.created_at.isoformat()}|{obj.id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset(query, model, cursor: Optional[str] = None):
+    """
+    Orders a select() of model for pagination, starting after cursor if given.
+    """
+    query = query.order_by(model.created_at, model.id)
+    if cursor is not None:
+        query = query.where(tuple_(model.created_at, model.id) > tuple_(*decode_cursor(cursor)))
+    return query
+
+
+async def get_page(db: AsyncSession, query, limit: int) -> Tuple[List, Optional[str]]:
+    """
+    Returns up to limit objects of a keyset() query, and the cursor of the next page if there's one.
+    """
+    result = await db.execute(query.limit(limit + 1))
+    objs = result.scalars().all()
+    if len(objs) <= limit:
+        return objs, None
+    objs = objs[:limit]
+    return objs, encode_cursor(objs[-1])
+
+
+async def stream_ndjson(query, to_external: ToExternal, batch_size: int) -> AsyncIterator[str]:
+    """
+    Yields the objects of a query as JSON lines, fetched batch_size at a time from a server-side cursor.
+    Uses its own session, the request's one may be closed while the response streams.
+    """
+    async with session_manager.read_session() as db:
+        result = await db.stream(query.execution_options(yield_per=batch_size))
+        async for objs in result.scalars().partitions():
+            external = await to_external(objs)
+            yield "".join(f"{obj.model_dump_json()}\n" for obj in external)
+            # Nothing refers to the batch anymore, don't keep it in the identity map
+            db.expunge_all()
+
+
+async def list_response(
+    db: AsyncSession,
+    response: Response,
+    query,
+    model,
+    cursor: Optional[str],
+    limit: int,
+    stream: bool,
+    to_external: ToExternal,
+):
+    """
+    A page of query, the next page's cursor in the NEXT_CURSOR_HEADER header, or with stream
+    every object after cursor as NDJSON.
+    """
+    query = keyset(query, model, cursor)
+    if stream:
+        return StreamingResponse(
+            stream_ndjson(query, to_external, config.ADMIN_STREAM_BATCH_SIZE),
+            media_type="application/x-ndjson",
+        )
+    objs, next_cursor = await get_page(db, query, limit)
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return await to_external(objs)
@@ -0,0 +1,87 @@
+# Loading profiles: which relationships each kind of request loads.
+# Every relationship is lazy="selectin" in models.py, so loading one object without options
+# cascades through all its relations and theirs. A profile turns all of them off (noload)
+# and eagerly loads only what the endpoints using it serialize.
+#
+# usage:
+# stmt = select(models.Answer).options(*profile_options(models.Answer, "feed"))
+from typing import Dict, List
+
+from sqlalchemy.orm import noload, selectinload
+
+import models
+
+
+def _related(model, *relationships: str) -> List:
+    # Load the relationships themselves, but none of their own relations
+    return [selectinload(getattr(model, name)).noload("*") for name in relationships]
+
+
+PROFILES: Dict[str, Dict[type, List]] = {
+    # GET /answers: AnswerExternalUserModel and the question of the day
+    "feed": {
+        models.Answer: _related(models.Answer, "question"),
+        models.Question: [],
+    },
+    # GET /answers/views: ids and counters only
+    "views": {
+        models.Answer: [],
+    },
+    # Streaming an answer's audio: its audio_location only
+    "audio": {
+        models.Answer: [],
+    },
+    # Single answers returned as AnswerExternalModel
+    "answer": {
+        models.Answer: _related(
+            models.Answer,
+            "author",
+            "viewed_by",
+            "question",
+            "embeddings",
+            "votes",
+            "flags",
+        ),
+    },
+    # Authenticating a request: the user's own columns only
+    "auth": {
+        models.User: [],
+    },
+    # Users returned as UserModel
+    "user": {
+        models.User: _related(
+            models.User,
+            "answers_authored",
+            "answers_viewed",
+            "votes",
+            "flags",
+            "test_groups",
+            "topic_subscriptions",
+        ),
+    },
+    # Admin list endpoints, returning the *UpdateModel schemas
+    "admin-list": {
+        models.User: [],
+        models.Question: [],
+        models.Answer: _related(models.Answer, "author", "viewed_by"),
+        models.Flag: [],
+        models.Vote: [],
+        models.Embedding: [],
+        models.Test: [],
+        models.TestGroup: [],
+    },
+}
+
+
+def profile_options(model, profile: str = None) -> List:
+    """
+    Returns the loader options of a profile for a model, to pass to select().options().
+    Without a profile, the relationships' default loading from models.py applies.
+    """
+    if profile is None:
+        return []
+    try:
+        options = PROFILES[profile][model]
+    except KeyError:
+        raise ValueError(f"No '{profile}' loading profile for {model.__name__}")
+    return [noload("*"), *options]
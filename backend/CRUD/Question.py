@@ -1,4 +1,4 @@
-from sqlalchemy import select
+from sqlalchemy import select, update
 import uuid
 from typing import Dict, List, Tuple, Union
 from fastapi import HTTPException
@@ -10,6 +10,7 @@ from schemas import (
 )
 import models
 from config import config
+from database import save
 import random
 
 from CRUD.Object import CRUDObject, check_related_object
@@ -19,9 +20,13 @@ from CRUD.Object import CRUDObject, check_related_object
 class CRUDQuestion(CRUDObject):
     # Depending on 'as_pydantic', return either a pydantic or sqlalchemy model
     async def get(
-        self, id: uuid.UUID = None, as_pydantic=True, query_dict: Dict = None
+        self,
+        id: uuid.UUID = None,
+        as_pydantic=True,
+        query_dict: Dict = None,
+        profile: str = None,
     ) -> Union[QuestionExternalModel, models.Question]:
-        question = await super().get(id, query_dict)
+        question = await super().get(id, query_dict, profile=profile)
         if question is None:
             raise HTTPException(status_code=404, detail="Question not found")
         return question
@@ -30,17 +35,14 @@ class CRUDQuestion(CRUDObject):
         """
         Sets a question as question of the day.
         """
-        # Unset previous question of the day
-        previous_question = await self.get(query_dict={"of_the_day": True})
-        if previous_question is not None and previous_question.id != id:
-            previous_question.of_the_day = False
-            await self.db.commit()
-        # elif previous_question.id == id:
-        #     raise HTTPException(
-        #         status_code=400, detail="Question is already question of the day"
-        #     )
+        # Unset previous question of the day, written along with the new one
+        await self.db.execute(
+            update(models.Question)
+            .where(models.Question.of_the_day == True)
+            .where(models.Question.id != id)
+            .values(of_the_day=False)
+        )
         question = await self.get(id, as_pydantic=False)
         question.of_the_day = True
-        await self.db.commit()
-        await self.db.refresh(question)
+        await save(self.db, question)
         return QuestionExternalModel.model_validate(question)
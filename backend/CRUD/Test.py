@@ -10,6 +10,7 @@ from schemas import (
 )
 import models
 from config import config
+from database import save
 
 from CRUD.Object import CRUDObject, check_related_object
 
@@ -21,13 +22,12 @@ class CRUDTest(CRUDObject):
         test = models.Test(**obj_in_data)
         try:
             self.db.add(test)
-            await self.db.commit()
-            await self.db.refresh(test)
+            await save(self.db, test)
         except Exception as e:
             if 'duplicate key value violates unique constraint "tests_name_key"' in str(e):
                 raise Exception(f"Test {test.name} already exists")
             raise e
         return test
     
-    async def get(self, id: uuid.UUID = None, query_dict: Dict = None) -> models.Test:
-        return await super().get(id, query_dict)
\ No newline at end of file
+    async def get(self, id: uuid.UUID = None, query_dict: Dict = None, profile: str = None) -> models.Test:
+        return await super().get(id, query_dict, profile=profile)
\ No newline at end of file
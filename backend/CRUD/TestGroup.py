@@ -10,6 +10,7 @@ from schemas import (
 )
 import models
 from config import config
+from database import save
 
 from CRUD.Object import CRUDObject, check_related_object
 
@@ -21,6 +22,14 @@ class CRUDTestGroup(CRUDObject):
         # Get the related objects
         user = await check_related_object(test_group_in, models.User, "user_id", self.db)
         test = await check_related_object(test_group_in, models.Test, "test_id", self.db)
+        # One version per user per test, see test_groups_test_id_user_id_key
+        existing = await self.db.execute(
+            select(models.TestGroup.id)
+            .where(models.TestGroup.test_id == test.id)
+            .where(models.TestGroup.user_id == user.id)
+        )
+        if existing.first() is not None:
+            raise HTTPException(status_code=400, detail="User already has a version of this test")
         # Create the test_group
         obj_in_data = test_group_in.model_dump()
         test_group = models.TestGroup(**obj_in_data)
@@ -28,7 +37,6 @@ class CRUDTestGroup(CRUDObject):
         test_group.user = user
         test_group.test = test
         self.db.add(test_group)
-        await self.db.commit()
-        await self.db.refresh(test_group)
+        await save(self.db, test_group)
         return test_group
     
\ No newline at end of file
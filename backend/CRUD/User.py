@@ -15,7 +15,10 @@ from schemas import (
 )
 import models
 from CRUD.Object import CRUDObject, check_related_object
-from firebase import Firebase
+from CRUD.Profiles import profile_options
+from firebase import subscription_batcher
+from auth_cache import principal_cache
+from database import save
 
 
 # Needs a custom Create to handle creation of related objects
@@ -28,11 +31,16 @@ class CRUDUser:
         ids: List[uuid.UUID] = None,
         query_dict: Dict = None,
         related: List[str] = None,
+        profile: str = None,
     ) -> List[models.User]:
         """
         Retrieves a list of users from the database based on the provided ids or query_dict.
         """
         stmt = select(models.User).where(models.User.is_active == True)
+        if profile is not None:
+            # The user may already be in the session, loaded with another profile
+            stmt = stmt.options(*profile_options(models.User, profile))
+            stmt = stmt.execution_options(populate_existing=True)
         if ids is not None:
             stmt = stmt.where(models.User.id.in_(ids))
         if query_dict:
@@ -50,6 +58,7 @@ class CRUDUser:
         ids: List[uuid.UUID] = None,
         query_dict: Dict = None,
         related: List[str] = None,
+        profile: str = "user",
     ) -> List[UserModel]:
         """
         Retrieves a list of User models from the database.
@@ -58,13 +67,18 @@ class CRUDUser:
             ids (List[uuid.UUID], optional): A list of UUIDs to filter the users. If provided, only users with these UUIDs will be returned.
             query_dict (Dict, optional): A dictionary of query parameters to filter the users. The keys should be column names and the values should be the values to filter by.
             related (List, optional): A list of related entities to load along with the users. Each entity should be a string representing the name of a relationship.
+            profile (str, optional): The loading profile from CRUD.Profiles, 'user' loads what UserModel needs.
         """
-        users = await self._retrieve(ids, query_dict, related=related)
+        users = await self._retrieve(ids, query_dict, related=related, profile=profile)
 
         return [UserModel.model_validate(user) for user in users]
 
     async def get_one(
-        self, id: uuid.UUID = None, query_dict: Dict = None, related: List[str] = None
+        self,
+        id: uuid.UUID = None,
+        query_dict: Dict = None,
+        related: List[str] = None,
+        profile: str = "user",
     ) -> UserModel:
         """
         Retrieves a single user from the database based on the provided ids or query_dict.
@@ -73,11 +87,12 @@ class CRUDUser:
             id (uuid.UUID, optional): A UUID to filter the users. If provided, only users with this UUID will be returned.
             query_dict (Dict, optional): A dictionary of query parameters to filter the users. The keys should be column names and the values should be the values to filter by.
             related (List, optional): A list of related entities to load along with the users. Each entity should be a string representing the name of a relationship.
+            profile (str, optional): The loading profile from CRUD.Profiles, 'user' loads what UserModel needs.
         """
         ids = [id]
         if id is None:
             ids = None
-        users = await self._retrieve(ids, query_dict, related=related)
+        users = await self._retrieve(ids, query_dict, related=related, profile=profile)
         if len(users) == 0:
             raise HTTPException(status_code=404, detail="User not found")
 
@@ -90,14 +105,14 @@ class CRUDUser:
         Changes the subscription status of a user to a topic.
         """
         
-        user = await self._retrieve(ids=[user_id])
+        user = await self._retrieve(ids=[user_id], profile="auth")
         user = user[0]
         
-        print(f'topic: {topic.topic}, subscription_status: {topic.subscription_status}')
-        if topic.subscription_status:
-            await Firebase().subscribe_to_topic(topic=topic.topic, tokens=[user.firebase_token])
-        else:
-            await Firebase().unsubscribe_from_topic(topic=topic.topic, tokens=[user.firebase_token])
+        # Mirrored to Firebase in the background, in batches, once the row below is committed
+        if user.firebase_token is not None:
+            subscription_batcher.add_after_commit(
+                self.db, topic.topic, user.firebase_token, topic.subscription_status
+            )
         
         topic_subscription = await self.db.execute(
             select(models.TopicSubscription)
@@ -114,18 +129,18 @@ class CRUDUser:
             self.db.add(topic_subscription)
         else:
             topic_subscription.subscription_status = topic.subscription_status
-        await self.db.commit()
-        user = await self._retrieve(ids=[user_id])
+        await save(self.db)
+        user = await self._retrieve(ids=[user_id], profile="user")
         return UserModel.model_validate(user[0])
 
     async def update(self, user_id: uuid.UUID, user: UserUpdateModel) -> UserModel:
         """
         Updates a user in the database.
         """
-        db_user = await self._retrieve(ids=[user_id])
+        db_user = await self._retrieve(ids=[user_id], profile="user")
         db_user = db_user[0]
         for key, value in user.model_dump(exclude_unset=True).items():
             setattr(db_user, key, value)
-        await self.db.commit()
-        await self.db.refresh(db_user)
+        await save(self.db, db_user)
+        principal_cache.invalidate(user_id)
         return UserModel.model_validate(db_user)
@@ -1,42 +1,78 @@
-from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 from fastapi import HTTPException
+from datetime import datetime
+import uuid
 
-from schemas import VoteCreateModel
+from schemas import VoteCreateModel, VoteMinimalModel, UserMinimalModel, AnswerMinimalModel
 import models
+from database import save
 
-from CRUD.Object import CRUDObject, check_related_object
+from CRUD.Object import CRUDObject
+
+# Columns of the vote and its related objects, as serialized in VoteExternalModel
+VOTE_COLUMNS = ("created_at", "updated_at", *VoteMinimalModel.model_fields)
+USER_COLUMNS = tuple(UserMinimalModel.model_fields)
+ANSWER_COLUMNS = tuple(AnswerMinimalModel.model_fields)
 
 # Needs a custom Create to handle creation of related objects
 class CRUDVote(CRUDObject):
     async def create(self, vote_in: VoteCreateModel) -> models.Vote:
         # VoteCreateModel has a field for the related Answer and User
-        # Get the related objects
-        answer = await check_related_object(vote_in, models.Answer, "answer_id", self.db)
-        user = await check_related_object(vote_in, models.User, "user_id", self.db)
-        # Assure the user has not already voted on the answer
-        try:
-            stmt = select(models.Vote).filter(
-                models.Vote.answer_id == answer.id,
-                models.Vote.user_id == user.id,
+        # Insert the vote and add to votes_count in Answer in a single statement,
+        # which returns the vote, its answer and its user.
+        # The (answer_id, user_id) unique constraint rejects duplicate votes,
+        # and the foreign keys reject missing answers and users.
+        # Errors are raised as they are, the session's owner rolls back.
+        votes = models.Vote.__table__
+        answers = models.Answer.__table__
+        users = models.User.__table__
+        now = datetime.utcnow()
+        new_vote = (
+            insert(votes)
+            .values(
+                id=uuid.uuid4(),
+                created_at=now,
+                updated_at=now,
+                **vote_in.model_dump(),
             )
-            vote = await self.db.execute(stmt)
-            vote = vote.scalar_one_or_none()
-            if vote is not None:
-                raise Exception("User has already voted on this answer")
-        except Exception as e:
-            if 'Multiple rows were found' in str(e):
-                raise Exception("User has already voted on this answer multiple times")
-            else:
-                raise e
-        # Create the Vote object
-        obj_in_data = vote_in.model_dump()
-        vote = models.Vote(**obj_in_data)
-        # Set the related objects
-        vote.answer = answer
-        vote.user = user
-        self.db.add(vote)
-        answer.votes_count += 1
-        await self.db.commit()
-        await self.db.refresh(vote)
+            .on_conflict_do_nothing(constraint="votes_answer_id_user_id_key")
+            .returning(*[votes.c[name] for name in VOTE_COLUMNS])
+            .cte("new_vote")
+        )
+        stmt = (
+            update(answers)
+            .where(answers.c.id == new_vote.c.answer_id)
+            .where(users.c.id == new_vote.c.user_id)
+            .values(votes_count=answers.c.votes_count + 1)
+            .returning(
+                *[new_vote.c[name].label(f"vote_{name}") for name in VOTE_COLUMNS],
+                *[users.c[name].label(f"user_{name}") for name in USER_COLUMNS],
+                *[answers.c[name].label(f"answer_{name}") for name in ANSWER_COLUMNS],
+            )
+        )
+        try:
+            result = await self.db.execute(stmt)
+            row = result.mappings().one_or_none()
+        except IntegrityError as e:
+            if "votes_answer_id_fkey" in str(e):
+                raise HTTPException(status_code=404, detail="Answer not found")
+            if "votes_user_id_fkey" in str(e):
+                raise HTTPException(status_code=404, detail="User not found")
+            raise e
+        if row is None:
+            raise Exception("User has already voted on this answer")
+        await save(self.db)
+        vote = models.Vote(**{name: row[f"vote_{name}"] for name in VOTE_COLUMNS})
+        # Set without loading or cascading anything, the rows came back with the vote
+        set_committed_value(
+            vote, "user", models.User(**{name: row[f"user_{name}"] for name in USER_COLUMNS})
+        )
+        set_committed_value(
+            vote,
+            "answer",
+            models.Answer(**{name: row[f"answer_{name}"] for name in ANSWER_COLUMNS}),
+        )
         return vote
-    
\ No newline at end of file
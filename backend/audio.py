@@ -0,0 +1,297 @@
+# Audio file helpers. Answers' audio is stored on the drive under config.AUDIO_FILE_PATH
+
+import asyncio
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Signatures of the containers the clients record in, mapped to their MIME type
+AUDIO_SIGNATURES = [
+    (4, b"ftyp", "audio/mp4"),  # AAC in .mp4/.m4a (Android and iOS)
+    (8, b"WAVE", "audio/wav"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"ID3", "audio/mpeg"),
+]
+DEFAULT_AUDIO_MEDIA_TYPE = "audio/mp4"
+
+RANGE_HEADER_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+@dataclass
+class AudioRead:
+    audio_location: uuid.UUID
+    audio_data: Optional[bytes]  # None when the file couldn't be read
+    latency: float  # seconds spent waiting for the read, including queueing
+    error: Optional[str] = None
+
+
+class AudioReadStats:
+    """
+    Latency of the reads of read_audio_batch, cache hits included, and how many failed.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, read: AudioRead):
+        self.reads += 1
+        if read.error is not None:
+            self.failures += 1
+        self.total_latency += read.latency
+        self.max_latency = max(self.max_latency, read.latency)
+
+    def stats(self) -> dict:
+        return {
+            "reads": self.reads,
+            "read_failures": self.failures,
+            "avg_read_latency": self.total_latency / self.reads if self.reads else 0.0,
+            "max_read_latency": self.max_latency,
+        }
+
+
+class AudioCache:
+    """
+    In-memory LRU cache of audio files keyed by audio_location, bounded by total bytes.
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[uuid.UUID, bytes] = OrderedDict()
+
+    def get(self, audio_location: uuid.UUID) -> Optional[bytes]:
+        audio_data = self._entries.get(audio_location)
+        if audio_data is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(audio_location)
+        self.hits += 1
+        return audio_data
+
+    def put(self, audio_location: uuid.UUID, audio_data: bytes):
+        # Files bigger than the whole budget would only flush everything else out
+        if self.max_bytes <= 0 or len(audio_data) > self.max_bytes:
+            return
+        self.invalidate(audio_location)
+        self._entries[audio_location] = audio_data
+        self.size += len(audio_data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, audio_location: uuid.UUID):
+        audio_data = self._entries.pop(audio_location, None)
+        if audio_data is not None:
+            self.size -= len(audio_data)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "size": self.size,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+audio_cache = AudioCache(config.AUDIO_CACHE_MAX_BYTES)
+read_stats = AudioReadStats()
+
+
+# All audio file I/O goes through this bounded pool so disk work never blocks the event loop
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=config.AUDIO_IO_WORKERS, thread_name_prefix="audio-io"
+        )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def run_in_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), func, *args)
+
+
+def audio_path(audio_location: uuid.UUID) -> str:
+    return f"{config.AUDIO_FILE_PATH}{audio_location}"
+
+
+def guess_audio_media_type(path: str) -> str:
+    """
+    Guesses the MIME type of an audio file from its first bytes.
+    """
+    with open(path, "rb") as f:
+        header = f.read(16)
+    for offset, signature, media_type in AUDIO_SIGNATURES:
+        if header[offset : offset + len(signature)] == signature:
+            return media_type
+    return DEFAULT_AUDIO_MEDIA_TYPE
+
+
+def parse_range_header(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single 'bytes=start-end' Range header into an inclusive (start, end) tuple.
+    Returns None if the whole file should be sent.
+    """
+    if range_header is None:
+        return None
+    match = RANGE_HEADER_REGEX.match(range_header.strip())
+    if match is None:
+        # Multiple ranges or other units aren't supported, fall back to the whole file
+        return None
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        # Suffix range, last n bytes
+        length = int(end)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def iter_audio_file(path: str, start: int, end: int) -> Iterator[bytes]:
+    """
+    Yields the inclusive byte range [start, end] of a file in chunks of config.AUDIO_CHUNK_SIZE.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(config.AUDIO_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def audio_file_size(path: str) -> int:
+    return os.stat(path).st_size
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _delete_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _file_info(path: str) -> Tuple[int, str]:
+    return audio_file_size(path), guess_audio_media_type(path)
+
+
+async def read_audio(audio_location: uuid.UUID) -> bytes:
+    """
+    Reads the audio file of an answer without blocking the event loop, going through audio_cache.
+    """
+    audio_data = audio_cache.get(audio_location)
+    if audio_data is None:
+        audio_data = await run_in_executor(_read_file, audio_path(audio_location))
+        audio_cache.put(audio_location, audio_data)
+    return audio_data
+
+
+async def write_audio(audio_location: uuid.UUID, audio_data: bytes):
+    """
+    Writes the audio file of an answer without blocking the event loop.
+    """
+    await run_in_executor(_write_file, audio_path(audio_location), audio_data)
+    audio_cache.invalidate(audio_location)
+
+
+async def delete_audio(audio_location: uuid.UUID):
+    """
+    Deletes the audio file of an answer without blocking the event loop, if it exists.
+    """
+    await run_in_executor(_delete_file, audio_path(audio_location))
+    audio_cache.invalidate(audio_location)
+
+
+async def audio_info(audio_location: uuid.UUID) -> Tuple[int, str]:
+    """
+    Returns the size and MIME type of the audio file of an answer.
+    """
+    return await run_in_executor(_file_info, audio_path(audio_location))
+
+
+async def read_audio_batch(
+    audio_locations: List[uuid.UUID], concurrency: int = None
+) -> List[AudioRead]:
+    """
+    Reads several audio files concurrently, at most 'concurrency' at a time
+    (config.AUDIO_BATCH_CONCURRENCY by default). Results keep the order of audio_locations.
+    A file that can't be read is a miss, its AudioRead has no audio_data, the others are still returned.
+    """
+    semaphore = asyncio.Semaphore(concurrency or config.AUDIO_BATCH_CONCURRENCY)
+
+    async def _read(audio_location: uuid.UUID) -> AudioRead:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                read = AudioRead(
+                    audio_location,
+                    await read_audio(audio_location),
+                    time.perf_counter() - start,
+                )
+            except OSError as e:
+                logger.warning("Reading audio %s failed: %s", audio_location, e)
+                read = AudioRead(
+                    audio_location, None, time.perf_counter() - start, error=str(e)
+                )
+            read_stats.record(read)
+            return read
+
+    return await asyncio.gather(*[_read(location) for location in audio_locations])
@@ -0,0 +1,75 @@
+# Cache of authenticated users, keyed by JWT subject
+# Each worker process has its own cache, so changes made through another worker
+# are picked up once the entry expires (config.AUTH_CACHE_TTL)
+
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from config import config
+from schemas import UserPrincipalModel
+
+
+class PrincipalCache:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Tuple[float, UserPrincipalModel]] = (
+            OrderedDict()
+        )
+        # Subjects of each user's entries, so that invalidate doesn't scan the cache
+        self._subjects: Dict[uuid.UUID, Set[str]] = {}
+
+    def get(self, subject: str) -> Optional[UserPrincipalModel]:
+        entry = self._entries.get(subject)
+        if entry is None or entry[0] < time.monotonic():
+            self._drop(subject)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(subject)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, subject: str, principal: UserPrincipalModel):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        self._drop(subject)
+        self._entries[subject] = (time.monotonic() + self.ttl, principal)
+        self._subjects.setdefault(principal.id, set()).add(subject)
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, subject: str):
+        entry = self._entries.pop(subject, None)
+        if entry is None:
+            return
+        subjects = self._subjects[entry[1].id]
+        subjects.discard(subject)
+        if not subjects:
+            del self._subjects[entry[1].id]
+
+    def invalidate(self, user_id: uuid.UUID):
+        """
+        Drops every entry of a user, whatever subject it was cached under.
+        """
+        for subject in self._subjects.pop(user_id, ()):
+            del self._entries[subject]
+
+    def clear(self):
+        self._entries.clear()
+        self._subjects.clear()
+
+    def stats(self) -> dict:
+        return {
+            "ttl": self.ttl,
+            "max_size": self.max_size,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+principal_cache = PrincipalCache(config.AUTH_CACHE_TTL, config.AUTH_CACHE_MAX_SIZE)
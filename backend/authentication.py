@@ -1,6 +1,9 @@
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from pydantic import ValidationError
 
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
@@ -8,16 +11,21 @@ from sqlalchemy.orm import selectinload
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, Annotated
+from typing import Optional, Annotated, List, Tuple
+import asyncio
+import time
 import os
 
 import models
 import schemas
-from database import get_db
+from database import get_db, save
 from config import config
+from auth_cache import principal_cache
+from experiments import assignment_row, experiment_registry, record_assignments
 
-from CRUD import TestGroup, Test, User
+from CRUD import User
 
 #
 ACCESS_TOKEN_EXPIRE_MINUTES = int(config.ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -30,25 +38,110 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login/username")
 
 
+class PasswordPool:
+    """
+    Bounded thread pool for bcrypt, which takes ~100-300 ms per call and would otherwise
+    block the event loop. bcrypt releases the GIL, so threads hash in parallel.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor: ThreadPoolExecutor | None = None
+        # metrics
+        self.in_flight = 0
+        self.calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    def _timed(self, submitted: float, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        return result, started - submitted, time.perf_counter() - started
+
+    async def run(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="password"
+            )
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            result, wait, run = await loop.run_in_executor(
+                self._executor, self._timed, time.perf_counter(), func, *args
+            )
+        finally:
+            self.in_flight -= 1
+        self.calls += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_run += run
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.max_workers, 0),
+            "calls": self.calls,
+            "avg_wait": self.total_wait / self.calls if self.calls else 0.0,
+            "max_wait": self.max_wait,
+            "avg_run": self.total_run / self.calls if self.calls else 0.0,
+        }
+
+
+password_pool = PasswordPool(config.PASSWORD_HASH_WORKERS)
+
+
 async def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return await password_pool.run(pwd_context.hash, password)
 
 
 async def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return await password_pool.run(pwd_context.verify, plain_password, hashed_password)
 
 
 async def get_user_by_username(
     db: AsyncSession, username: str
 ) -> models.User:  # This could be in CRUD
     userCRUD = User.CRUDUser(db)
-    user = await userCRUD._retrieve(
-        query_dict={"username": username},
-        related=["answers_authored", "answers_viewed", "topic_subscriptions"],
-    )
+    user = await userCRUD._retrieve(query_dict={"username": username}, profile="auth")
     return user[0] if len(user) > 0 else None
 
 
+async def get_principal_by_username(
+    db: AsyncSession, username: str
+) -> schemas.UserPrincipalModel:
+    """
+    Returns the slim authenticated user, from principal_cache or a single-row column query.
+    """
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+    result = await db.execute(
+        select(
+            models.User.id,
+            models.User.device_id,
+            models.User.username,
+            models.User.is_admin,
+            models.User.is_active,
+        )
+        .where(models.User.username == username)
+        .where(models.User.is_active == True)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    principal = schemas.UserPrincipalModel.model_validate(row._mapping)
+    principal_cache.put(username, principal)
+    return principal
+
+
 async def authenticate_user(
     db: AsyncSession, username: str, password: str
 ) -> models.User:
@@ -73,35 +166,82 @@ async def create_access_token(
     return encoded_jwt
 
 
-async def get_current_user(
-    db: AsyncSession = Depends(get_db),
-    token: str = Depends(oauth2_scheme),
-):
-    credentials_exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def decode_access_token(token: str) -> dict:
     try:
         payload = jwt.decode(
             token,
             key=SECRET_KEY,
             algorithms=[ALGORITHM],
         )
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(username=username)
     except JWTError:
-        raise credentials_exception
-    user = await get_user_by_username(db, username=token_data.username)
+        raise credentials_exception()
+    if payload.get("sub") is None:
+        raise credentials_exception()
+    return payload
+
+
+def principal_claims(user: models.User) -> dict:
+    """
+    Claims identifying the user in their access token.
+    uid, adm and ver let read-only endpoints authenticate without a database lookup.
+    """
+    return {
+        "sub": user.device_id,
+        "uid": str(user.id),
+        "adm": user.is_admin,
+        "ver": config.TOKEN_VERSION,
+    }
+
+
+async def get_current_user(
+    db: AsyncSession = Depends(get_db),
+    token: str = Depends(oauth2_scheme),
+):
+    payload = decode_access_token(token)
+    token_data = schemas.TokenData(username=payload["sub"])
+    user = await get_principal_by_username(db, username=token_data.username)
     if user is None:
-        raise credentials_exception
+        raise credentials_exception()
+    return user
+
+
+async def get_current_reader(
+    db: AsyncSession = Depends(get_db),
+    token: str = Depends(oauth2_scheme),
+) -> schemas.UserPrincipalModel:
+    """
+    Lightweight get_current_user for read-only endpoints, trusting the signed claims of the token.
+    Tokens without them, or issued under an older config.TOKEN_VERSION, are checked against the database.
+    Deactivating a user only takes effect here once their token expires or TOKEN_VERSION is bumped,
+    so endpoints that change data must keep using get_current_active_user.
+    """
+    payload = decode_access_token(token)
+    if payload.get("ver") == config.TOKEN_VERSION and "uid" in payload:
+        try:
+            return schemas.UserPrincipalModel(
+                id=payload["uid"],
+                device_id=payload["sub"],
+                username=payload["sub"],
+                is_admin=payload.get("adm", False),
+            )
+        except ValidationError:
+            raise credentials_exception()
+    user = await get_principal_by_username(db, username=payload["sub"])
+    if user is None:
+        raise credentials_exception()
     return user
 
 
 async def get_current_active_user(
-    current_user: Annotated[models.User, Depends(get_current_user)]
+    current_user: Annotated[schemas.UserPrincipalModel, Depends(get_current_user)]
 ):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -109,7 +249,7 @@ async def get_current_active_user(
 
 
 async def get_current_active_admin(
-    current_user: Annotated[models.User, Depends(get_current_user)]
+    current_user: Annotated[schemas.UserPrincipalModel, Depends(get_current_user)]
 ):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -123,10 +263,10 @@ async def register_user(
     db: AsyncSession = Depends(get_db),
 ) -> models.User:
     # Check if groups are valid
-    test_CRUD = Test.CRUDTest(db, models.Test)
+    experiments = {}
     for test_group in user.test_groups:
         try:
-            test = await test_CRUD.get(query_dict={"name": test_group["test"]})
+            test = await experiment_registry.lookup(db, test_group["test"])
             if test is None:
                 raise HTTPException(
                     status_code=404,
@@ -137,6 +277,7 @@ async def register_user(
                 status_code=400,
                 detail=f"Test name not provided",
             )
+        experiments[test.name] = test
 
     # If there's only device_id, generate a username, email, and password
     # If there's a username, email, or password, assure they're all present
@@ -155,8 +296,8 @@ async def register_user(
     else:
         user.username = user.device_id
         user.email = f"{user.device_id}@example.com"
-        # Hash and salt the password
-        user.password = await get_password_hash(user.device_id)
+        # The password is hashed and salted below
+        user.password = user.device_id
 
     db_user = models.User(
         device_id=user.device_id,
@@ -167,7 +308,7 @@ async def register_user(
 
     db.add(db_user)
     try:
-        await db.commit()
+        await save(db)
     except Exception as e:
         if "duplicate key value violates unique constraint" in str(e):
             if f"Key (username)=({user.username}) already exists" in str(e):
@@ -191,21 +332,182 @@ async def register_user(
         )
     created_user = await get_user_by_username(db, username=user.username)
 
-    test_CRUD = Test.CRUDTest(db, models.Test)
-    test_group_CRUD = TestGroup.CRUDTestGroup(db, models.TestGroup)
-    for test_group in user.test_groups:
-        test = await test_CRUD.get(query_dict={"name": test_group["test"]})
-        if test is None:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Test {test_group['test']} not found",
+    # Users are always bucketed, so a requested version isn't kept,
+    # the rows record the versions GET /experiments returns
+    await record_assignments(
+        db, [assignment_row(experiment, created_user.id) for experiment in experiments.values()]
+    )
+    await save(db)
+    return db_user
+
+
+# Labels of the unique user fields, as in register_user's error messages
+UNIQUE_USER_FIELDS = {
+    "device_id": "Device ID",
+    "username": "Username",
+    "email": "Email",
+}
+
+
+async def register_users_bulk(
+    users: List[schemas.UserCreateModel],
+    db: AsyncSession,
+) -> Tuple[List[dict], List[schemas.UserRegistrationConflictModel]]:
+    """
+    Registers many users in a single transaction.
+    Tests are looked up in experiment_registry, passwords are hashed in parallel in password_pool, and users and
+    test groups are inserted with multi-row INSERTs. Users that can't be registered, because
+    they're invalid or conflict with existing users or each other, are skipped and reported.
+    Returns the registered users, in request order, and the conflicts.
+    """
+    conflicts = []
+
+    def conflict(index: int, user: schemas.UserCreateModel, detail: str):
+        conflicts.append(
+            schemas.UserRegistrationConflictModel(
+                index=index, device_id=user.device_id, detail=detail
             )
-        test_group = await test_group_CRUD.create(
-            schemas.TestGroupCreateModel(
-                user_id=created_user.id,
-                test_id=test.id,
-                is_active=True,
-                version=test_group["version"],
+        )
+
+    # Tests by name, from the registry
+    test_names = {
+        test_group.get("test")
+        for user in users
+        for test_group in user.test_groups or []
+        if test_group.get("test") is not None
+    }
+    experiments = {}
+    for name in test_names:
+        experiment = await experiment_registry.lookup(db, name)
+        if experiment is not None:
+            experiments[name] = experiment
+
+    # Same checks as register_user, plus uniqueness within the request
+    rows = []
+    seen = {field: set() for field in UNIQUE_USER_FIELDS}
+    for index, user in enumerate(users):
+        if (
+            user.username is not None
+            or user.email is not None
+            or user.password is not None
+        ):
+            if (
+                user.username is None
+                or user.email is None
+                or user.password is None
+                or user.device_id is None
+            ):
+                conflict(
+                    index,
+                    user,
+                    "Device ID or username, email, and password must be provided",
+                )
+                continue
+        else:
+            user = user.model_copy(
+                update={
+                    "username": user.device_id,
+                    "email": f"{user.device_id}@example.com",
+                    "password": user.device_id,
+                }
+            )
+        test_groups = user.test_groups or []
+        if any("test" not in test_group for test_group in test_groups):
+            conflict(index, user, "Test name not provided")
+            continue
+        missing = [tg["test"] for tg in test_groups if tg["test"] not in experiments]
+        if missing:
+            conflict(index, user, f"Test {missing[0]} not found")
+            continue
+        repeated = [field for field in seen if getattr(user, field) in seen[field]]
+        if repeated:
+            field = repeated[0]
+            conflict(
+                index,
+                user,
+                f"{UNIQUE_USER_FIELDS[field]} {getattr(user, field)} is repeated in the request",
+            )
+            continue
+        for field in seen:
+            seen[field].add(getattr(user, field))
+        rows.append((index, user))
+
+    if len(rows) == 0:
+        return [], conflicts
+
+    passwords = await asyncio.gather(
+        *[get_password_hash(user.password) for _, user in rows]
+    )
+
+    # Executed as multi-row INSERTs of up to 1000 rows (insertmanyvalues).
+    # Rows conflicting with existing users are skipped and not returned.
+    users_table = models.User.__table__
+    result = await db.execute(
+        insert(users_table)
+        .on_conflict_do_nothing()
+        .returning(
+            users_table.c.id,
+            users_table.c.is_active,
+            users_table.c.device_id,
+            users_table.c.is_admin,
+            users_table.c.email,
+            users_table.c.username,
+            users_table.c.password,
+            users_table.c.firebase_token,
+        ),
+        [
+            {
+                "device_id": user.device_id,
+                "username": user.username,
+                "email": user.email,
+                "password": password,
+            }
+            for (_, user), password in zip(rows, passwords)
+        ],
+    )
+    created = {row.device_id: row._asdict() for row in result.all()}
+
+    # Tell which existing users the skipped rows conflicted with
+    skipped = [(index, user) for index, user in rows if user.device_id not in created]
+    if skipped:
+        existing = await db.execute(
+            select(
+                models.User.device_id, models.User.username, models.User.email
+            ).where(
+                or_(
+                    *[
+                        getattr(models.User, field).in_(
+                            [getattr(user, field) for _, user in skipped]
+                        )
+                        for field in UNIQUE_USER_FIELDS
+                    ]
+                )
             )
         )
-    return db_user
+        existing = existing.all()
+        for index, user in skipped:
+            detail = "User already exists"
+            for field, label in UNIQUE_USER_FIELDS.items():
+                value = getattr(user, field)
+                if any(getattr(row, field) == value for row in existing):
+                    detail = f"{label} {value} already exists"
+                    break
+            conflict(index, user, detail)
+
+    # Bucketed versions, as in register_user
+    await record_assignments(
+        db,
+        [
+            assignment_row(experiments[name], created[user.device_id]["id"])
+            for _, user in rows
+            if user.device_id in created
+            for name in {test_group["test"] for test_group in user.test_groups or []}
+        ],
+    )
+    await save(db)
+
+    conflicts.sort(key=lambda conflict: conflict.index)
+    registered = [
+        created[user.device_id] for _, user in rows if user.device_id in created
+    ]
+    return registered, conflicts
@@ -10,12 +10,85 @@ class Config:
     'database': os.environ.get('DB_NAME'),
   }
   SQLALCHEMY_DATABASE_URI = f"postgresql+asyncpg://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
-  
+  # Connection pool: connections kept open, extra ones opened under load, and seconds
+  # a checkout waits for a free connection before failing
+  DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+  DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+  DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+  # Connections older than this many seconds are replaced, -1 never replaces them
+  DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+  # Test connections with a round trip on checkout, dropping stale ones
+  DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'True') == 'True'
+  # Log every SQL statement
+  DB_ECHO = os.environ.get('DB_ECHO') == 'True'
+  # Prepared statements cached per connection, 0 behind pgbouncer in transaction mode
+  DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 100))
+  # Comma separated URLs of read replicas, read-only endpoints are spread over them
+  DB_REPLICA_URLS = [url for url in os.environ.get('DB_REPLICA_URLS', '').split(',') if url]
+  # Replicas more than this many seconds behind the primary get no reads until they catch up
+  DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+  DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+
   ACCESS_TOKEN_EXPIRE_MINUTES = os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES')
+  # Authenticated users are cached per token subject for this many seconds
+  AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 60))
+  AUTH_CACHE_MAX_SIZE = int(os.environ.get('AUTH_CACHE_MAX_SIZE', 10000))
+  # Threads hashing and verifying passwords with bcrypt, one per core by default
+  PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+  # Version of the claims in access tokens. Bump it to make read endpoints
+  # look every outstanding token's user up in the database again
+  TOKEN_VERSION = int(os.environ.get('TOKEN_VERSION', 1))
   
   AUDIO_FILE_PATH = os.environ.get('AUDIO_FILE_PATH')
+  # Size of the chunks the audio endpoint streams files in
+  AUDIO_CHUNK_SIZE = int(os.environ.get('AUDIO_CHUNK_SIZE', 64 * 1024))
+  # Max threads reading and writing audio files off the event loop
+  AUDIO_IO_WORKERS = int(os.environ.get('AUDIO_IO_WORKERS', 8))
+  # Max concurrent reads per batch, e.g. per feed page
+  AUDIO_BATCH_CONCURRENCY = int(os.environ.get('AUDIO_BATCH_CONCURRENCY', 8))
+  # Memory budget of the hot audio cache, 0 disables it
+  AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+  # Buffer view counter increments in memory and write them behind in batches
+  VIEW_BUFFER_ENABLED = os.environ.get('VIEW_BUFFER_ENABLED') == 'True'
+  VIEW_BUFFER_FLUSH_INTERVAL = float(os.environ.get('VIEW_BUFFER_FLUSH_INTERVAL', 5))
+  # Flush early once this many answers have pending views
+  VIEW_BUFFER_MAX_PENDING = int(os.environ.get('VIEW_BUFFER_MAX_PENDING', 1000))
+
+  # Seconds between reloads of the in-process A/B test registry, picking up other workers' changes
+  EXPERIMENTS_REFRESH_INTERVAL = float(os.environ.get('EXPERIMENTS_REFRESH_INTERVAL', 60))
+
+  # Min seconds between reloads of the registry when a request names an unknown test
+  EXPERIMENTS_MISS_REFRESH_INTERVAL = float(os.environ.get('EXPERIMENTS_MISS_REFRESH_INTERVAL', 1))
+
+  # Max concurrent sends of the notification outbox worker
+  NOTIFICATION_WORKERS = int(os.environ.get('NOTIFICATION_WORKERS', 2))
+  # New answers within this many seconds are notified as one message, 0 sends each one
+  NOTIFICATION_COALESCE_WINDOW = float(os.environ.get('NOTIFICATION_COALESCE_WINDOW', 300))
+  # ...or as soon as this many are pending
+  NOTIFICATION_COALESCE_THRESHOLD = int(os.environ.get('NOTIFICATION_COALESCE_THRESHOLD', 50))
+  # Notification outbox: seconds between polls, messages claimed per poll, and claims before
+  # a message is dead. Failed sends are retried after BASE * 2^(attempts - 1) seconds, up to MAX
+  OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 2))
+  OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+  OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+  OUTBOX_BACKOFF_BASE = float(os.environ.get('OUTBOX_BACKOFF_BASE', 5))
+  OUTBOX_BACKOFF_MAX = float(os.environ.get('OUTBOX_BACKOFF_MAX', 3600))
+  # Seconds a worker has to send the messages it claimed before others may claim them again
+  OUTBOX_LEASE = float(os.environ.get('OUTBOX_LEASE', 60))
+  # Topic subscription changes are pushed to Firebase in batches every this many seconds
+  SUBSCRIPTION_FLUSH_INTERVAL = float(os.environ.get('SUBSCRIPTION_FLUSH_INTERVAL', 5))
+  # Sends of a token before a retryable failure is given up on
+  SUBSCRIPTION_MAX_ATTEMPTS = int(os.environ.get('SUBSCRIPTION_MAX_ATTEMPTS', 3))
+  # Every token's subscriptions are pushed again from the topic_subscriptions rows at startup and
+  # every this many seconds, catching up on changes lost on a restart. 0 only reconciles at startup
+  SUBSCRIPTION_RECONCILE_INTERVAL = float(os.environ.get('SUBSCRIPTION_RECONCILE_INTERVAL', 86400))
 
   ADMIN_SECRET = os.environ.get('ADMIN_SECRET')
+  # Admin list endpoints: default and max rows per page, and rows fetched per round trip when streaming
+  ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 100))
+  ADMIN_MAX_PAGE_SIZE = int(os.environ.get('ADMIN_MAX_PAGE_SIZE', 1000))
+  ADMIN_STREAM_BATCH_SIZE = int(os.environ.get('ADMIN_STREAM_BATCH_SIZE', 500))
 
   HIDDEN_ENDPOINTS = os.environ.get('HIDDEN_ENDPOINTS') == 'True'
 
@@ -1,7 +1,10 @@
 # Database config for FastAPI, async PostrgresSQL via SQLAlchemy
 
-from typing import AsyncIterator
+import asyncio
+import time
+from typing import AsyncIterator, List
 from contextlib import asynccontextmanager
+from sqlalchemy import exc, text
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
     async_sessionmaker,
@@ -9,32 +12,204 @@ from sqlalchemy.ext.asyncio import (
     AsyncEngine,
 )
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from config import config
 
-engine = create_async_engine(config.SQLALCHEMY_DATABASE_URI,
-                            #  echo=True,
-                             future=True)
-
 Base = declarative_base()
-async_session = async_sessionmaker(engine, expire_on_commit=False)
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """
+    Queue pool keeping track of how long checkouts wait for a connection,
+    so that pool exhaustion shows up before requests start timing out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def recreate(self):
+        # Keep the metrics when the pool is recreated, eg after a disconnect
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.timeouts = self.timeouts
+        pool.total_wait = self.total_wait
+        pool.max_wait = self.max_wait
+        return pool
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": self.overflow(),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+def create_engine(url: str = config.SQLALCHEMY_DATABASE_URI) -> AsyncEngine:
+    """
+    The application's engine, its pool and statement caching set from config.
+    """
+    return create_async_engine(
+        url,
+        echo=config.DB_ECHO,
+        poolclass=MeteredQueuePool,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=config.DB_POOL_PRE_PING,
+        connect_args={
+            # SQLAlchemy's cache of prepared statements, and asyncpg's own
+            "prepared_statement_cache_size": config.DB_STATEMENT_CACHE_SIZE,
+            "statement_cache_size": config.DB_STATEMENT_CACHE_SIZE,
+        },
+    )
+
+
+# Seconds the replica is behind the primary, 0 when it has replayed everything it received.
+# A server not in recovery, eg a stand-in for a replica, is never behind.
+REPLICA_LAG = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.engine = create_engine(url)
+        self.sessionmaker = async_sessionmaker(bind=self.engine, autocommit=False)
+        # Unchecked replicas get no reads
+        self.healthy = False
+        self.lag: float | None = None
+        self.sessions = 0
+        self.failed_checks = 0
+
+    async def check(self, max_lag: float):
+        try:
+            async with self.engine.connect() as conn:
+                lag = (await conn.execute(REPLICA_LAG)).scalar()
+        except Exception as e:
+            url = self.engine.url.render_as_string(hide_password=True)
+            print(f"Checking replica {url} failed: {e}")
+            self.failed_checks += 1
+            self.healthy = False
+            self.lag = None
+            return
+        self.lag = None if lag is None else float(lag)
+        self.healthy = self.lag is not None and self.lag <= max_lag
+
+    def stats(self) -> dict:
+        return {
+            "url": self.engine.url.render_as_string(hide_password=True),
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "sessions": self.sessions,
+            "failed_checks": self.failed_checks,
+            **self.engine.pool.stats(),
+        }
 
 
 class DatabaseSessionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        max_replica_lag: float = config.DB_REPLICA_MAX_LAG,
+        check_interval: float = config.DB_REPLICA_CHECK_INTERVAL,
+    ):
+        self.max_replica_lag = max_replica_lag
+        self.check_interval = check_interval
         self._engine: AsyncEngine | None = None
         self._sessionmaker: async_sessionmaker | None = None
+        self._replicas: List[Replica] = []
+        self._next_replica = 0
+        self._task: asyncio.Task | None = None
+        # Read sessions sent to the primary for lack of a healthy replica
+        self.primary_reads = 0
 
-    def init(self, host: str = config.SQLALCHEMY_DATABASE_URI):
-        self._engine = create_async_engine(host, echo=True, future=True)
+    def init(
+        self,
+        host: str = config.SQLALCHEMY_DATABASE_URI,
+        replicas: List[str] = config.DB_REPLICA_URLS,
+    ):
+        self._engine = create_engine(host)
         self._sessionmaker = async_sessionmaker(bind=self._engine, autocommit=False)
+        self._replicas = [Replica(url) for url in replicas]
+
+    async def check_replicas(self):
+        await asyncio.gather(
+            *[replica.check(self.max_replica_lag) for replica in self._replicas]
+        )
+
+    async def _run(self):
+        while True:
+            await self.check_replicas()
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        # Replicas are checked in the background, reads go to the primary until one is healthy
+        if self._replicas and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
 
     async def close(self):
-        if self._engine is not None:
+        if self._engine is None:
             raise Exception("DatabaseSessionManager has not been initialized")
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for replica in self._replicas:
+            await replica.engine.dispose()
         await self._engine.dispose()
         self._engine = None
         self._sessionmaker = None
+        self._replicas = []
+
+    def pool_stats(self) -> dict:
+        if self._engine is None:
+            raise Exception("DatabaseSessionManager has not been initialized")
+        return {
+            "primary": self._engine.pool.stats(),
+            "primary_reads": self.primary_reads,
+            "replicas": [replica.stats() for replica in self._replicas],
+        }
+
+    def _read_sessionmaker(self) -> async_sessionmaker:
+        """
+        Round-robins over the healthy replicas, falling back to the primary.
+        """
+        healthy = [replica for replica in self._replicas if replica.healthy]
+        if not healthy:
+            self.primary_reads += 1
+            return self._sessionmaker
+        replica = healthy[self._next_replica % len(healthy)]
+        self._next_replica += 1
+        replica.sessions += 1
+        return replica.sessionmaker
 
     @asynccontextmanager
     async def connect(self) -> AsyncIterator[AsyncSession]:
@@ -52,7 +227,41 @@ class DatabaseSessionManager:
         if self._sessionmaker is None:
             raise Exception("DatabaseSessionManager has not been initialized")
 
-        session = self._sessionmaker()
+        async with self._session(self._sessionmaker) as session:
+            yield session
+
+    @asynccontextmanager
+    async def read_session(self) -> AsyncIterator[AsyncSession]:
+        """
+        Session on a replica, for reads that can be a few seconds behind the primary.
+        """
+        if self._sessionmaker is None:
+            raise Exception("DatabaseSessionManager has not been initialized")
+
+        async with self._session(self._read_sessionmaker()) as session:
+            yield session
+
+    @asynccontextmanager
+    async def unit_of_work(self) -> AsyncIterator[AsyncSession]:
+        """
+        Session for a request done in a single transaction. CRUD writes are only flushed,
+        see save(), and the handler commits once at the end. Whatever isn't committed is rolled back.
+        The commit isn't left to the dependency, which FastAPI exits after sending the response.
+        Objects aren't expired on commit, they hold what was just written.
+        """
+        if self._sessionmaker is None:
+            raise Exception("DatabaseSessionManager has not been initialized")
+
+        async with self._session(
+            self._sessionmaker, expire_on_commit=False, info={"unit_of_work": True}
+        ) as session:
+            yield session
+
+    @asynccontextmanager
+    async def _session(
+        self, sessionmaker: async_sessionmaker, **kwargs
+    ) -> AsyncIterator[AsyncSession]:
+        session = sessionmaker(**kwargs)
         try:
             yield session
         except Exception:
@@ -65,6 +274,30 @@ class DatabaseSessionManager:
 session_manager = DatabaseSessionManager()
 
 
+async def save(db: AsyncSession, *objs):
+    """
+    Writes the pending changes of a CRUD operation.
+    In a unit of work they're flushed, generated columns coming back with RETURNING.
+    Otherwise they're committed, and objs are refreshed as commit expires them.
+    """
+    if db.info.get("unit_of_work"):
+        await db.flush()
+        return
+    await db.commit()
+    for obj in objs:
+        await db.refresh(obj)
+
+
 async def get_db() -> AsyncIterator[AsyncSession]:
     async with session_manager.session() as session:
         yield session
+
+
+async def get_read_db() -> AsyncIterator[AsyncSession]:
+    async with session_manager.read_session() as session:
+        yield session
+
+
+async def get_uow_db() -> AsyncIterator[AsyncSession]:
+    async with session_manager.unit_of_work() as session:
+        yield session
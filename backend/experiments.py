@@ -0,0 +1,154 @@
+# In-process registry of the A/B tests (models.Test) and hash-based bucketing of users into their versions
+# A user's version is always derived from their id and the test name, so reads never hit the database.
+# TestGroup rows only record bucketed versions on writes (registration, exposures) for analytics.
+
+import hashlib
+import time
+import uuid
+from datetime import datetime
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from config import config
+
+
+@dataclass(frozen=True)
+class Experiment:
+    id: uuid.UUID
+    name: str
+    versions: Tuple[str, ...]
+
+
+def bucket(user_id: uuid.UUID, test_name: str, versions: Tuple[str, ...]) -> str:
+    """
+    Deterministically picks one of versions for a user.
+    Uses sha256 rather than hash(), which is salted per process.
+    """
+    digest = hashlib.sha256(f"{test_name}:{user_id}".encode()).digest()
+    return versions[int.from_bytes(digest[:8], "big") % len(versions)]
+
+
+class ExperimentRegistry:
+    def __init__(self, refresh_interval: float, miss_refresh_interval: float = 1):
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self.loaded_at: float | None = None
+        self.refreshes = 0
+        self._experiments: Dict[str, Experiment] = {}
+
+    @property
+    def stale(self) -> bool:
+        return (
+            self.loaded_at is None
+            or time.monotonic() - self.loaded_at > self.refresh_interval
+        )
+
+    async def refresh(self, db: AsyncSession):
+        """
+        Reloads the active tests. Called after tests are created, and every refresh_interval
+        seconds so that other worker processes pick up changes.
+        """
+        result = await db.execute(
+            select(models.Test.id, models.Test.name, models.Test.versions).where(
+                models.Test.is_active == True
+            )
+        )
+        self._experiments = {
+            name: Experiment(id, name, tuple(versions))
+            for id, name, versions in result.all()
+            if versions
+        }
+        self.loaded_at = time.monotonic()
+        self.refreshes += 1
+
+    async def ensure_loaded(self, db: AsyncSession):
+        if self.stale:
+            await self.refresh(db)
+
+    def get(self, name: str) -> Optional[Experiment]:
+        return self._experiments.get(name)
+
+    async def lookup(self, db: AsyncSession, name: str) -> Optional[Experiment]:
+        """
+        Like get, but reloads the tests on a miss, in case the test was created on another worker.
+        Misses reload at most once every miss_refresh_interval seconds, so unknown names can't
+        make every request query the tests.
+        """
+        await self.ensure_loaded(db)
+        experiment = self._experiments.get(name)
+        if experiment is None and time.monotonic() - self.loaded_at > self.miss_refresh_interval:
+            await self.refresh(db)
+            experiment = self._experiments.get(name)
+        return experiment
+
+    def assign(self, user_id: uuid.UUID, name: str) -> Optional[str]:
+        experiment = self._experiments.get(name)
+        if experiment is None:
+            return None
+        return bucket(user_id, experiment.name, experiment.versions)
+
+    def assignments(self, user_id: uuid.UUID) -> Dict[str, str]:
+        """
+        The user's version of every active test.
+        """
+        return {
+            name: bucket(user_id, name, experiment.versions)
+            for name, experiment in self._experiments.items()
+        }
+
+    def stats(self) -> dict:
+        return {
+            "experiments": len(self._experiments),
+            "refreshes": self.refreshes,
+            "age": (
+                None if self.loaded_at is None else time.monotonic() - self.loaded_at
+            ),
+        }
+
+
+experiment_registry = ExperimentRegistry(
+    config.EXPERIMENTS_REFRESH_INTERVAL, config.EXPERIMENTS_MISS_REFRESH_INTERVAL
+)
+
+
+def assignment_row(experiment: Experiment, user_id: uuid.UUID) -> dict:
+    """
+    The TestGroup row of a user's bucketed version of a test.
+    """
+    now = datetime.utcnow()
+    return {
+        "id": uuid.uuid4(),
+        "created_at": now,
+        "updated_at": now,
+        "is_active": True,
+        "test_id": experiment.id,
+        "user_id": user_id,
+        "version": bucket(user_id, experiment.name, experiment.versions),
+    }
+
+
+async def record_assignments(db: AsyncSession, rows: List[dict]):
+    """
+    Persists assignment_row()s as TestGroup rows, without committing.
+    Rows left with another version, e.g. by an older explicit assignment, are corrected
+    so that they match what GET /experiments returns.
+    """
+    if not rows:
+        return
+    test_groups = models.TestGroup.__table__
+    stmt = insert(test_groups)
+    # The (test_id, user_id) unique constraint keeps concurrent writes from both inserting,
+    # rows already holding the bucketed version aren't rewritten
+    await db.execute(
+        stmt.on_conflict_do_update(
+            constraint="test_groups_test_id_user_id_key",
+            set_={"version": stmt.excluded.version, "updated_at": stmt.excluded.updated_at},
+            where=test_groups.c.version != stmt.excluded.version,
+        ),
+        rows,
+    )
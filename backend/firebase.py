@@ -1,14 +1,22 @@
-from firebase_admin import messaging, initialize_app, _apps
+from firebase_admin import exceptions, messaging, initialize_app, _apps
+import asyncio
 import json
+import logging
+import time
 import requests
-from typing import List
+from typing import Dict, List, Tuple
+from sqlalchemy import event, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
 
 from config import config
-from CRUD import User, Question
+from database import session_manager
+from CRUD import Question
 from schemas import UserModel, Title, Body, Notification, Message
 import models
 
+logger = logging.getLogger(__name__)
+
 
 class Firebase:
     def __init__(self):
@@ -20,7 +28,11 @@ class Firebase:
     async def send_message(self, message: Message) -> str:
         """
         Sends a message to the Firebase Cloud Messaging service.
+        firebase_admin is synchronous, the HTTPS call runs in a thread to keep the event loop free.
         """
+        return await asyncio.to_thread(self._send_message, message)
+
+    def _send_message(self, message: Message) -> str:
         data = None
         notification = None
         if message.data is not None:
@@ -31,7 +43,7 @@ class Firebase:
                 body=message.notification.body,
                 image=message.notification.image,
             )
-        print(f"Notifying with data: {data} and notification: {notification}")
+        logger.debug("Notifying with data: %s and notification: %s", data, notification)
         # Can be send either to a 1) Topic/Condition, 2) Single Device, or 3) Multiple Devices
 
         match message:
@@ -40,8 +52,9 @@ class Firebase:
                     raise ValueError(
                         "Cannot send message to both topic/condition and specfic device(s)"
                     )
-                print(
-                    f"Sending message to topic/condition: {message.topic or message.condition}"
+                logger.debug(
+                    "Sending message to topic/condition: %s",
+                    message.topic or message.condition,
                 )
                 return messaging.send(
                     messaging.Message(
@@ -53,8 +66,8 @@ class Firebase:
                 )
             case Message(tokens=list):
                 if len(message.tokens) == 1:
-                    print(f"Sending message to single device: {message.tokens[0]}")
-                    return await messaging.send(
+                    logger.debug("Sending message to single device: %s", message.tokens[0])
+                    return messaging.send(
                         messaging.Message(
                             data=data,
                             notification=notification,
@@ -62,7 +75,7 @@ class Firebase:
                         )
                     )
                 else:
-                    print(f"Sending message to multiple devices: {message.tokens}")
+                    logger.debug("Sending message to multiple devices: %s", message.tokens)
                     return messaging.send_multicast(
                         messaging.MulticastMessage(
                             data=data,
@@ -75,56 +88,284 @@ class Firebase:
                     "Invalid message: must have either topic/condition or tokens"
                 )
 
-    async def send_new_question_notification(
-        self, db: AsyncSession, message: Message = None
-    ) -> str:
-        """
-        Sends a notification to all users that a new question is now active.
-        """
-        questionCRUD = Question.CRUDQuestion(db, models.Question)
-        question = await questionCRUD.get(query_dict={"of_the_day": True})
-
-        if message is None:
-            message = Message(
-                topic="new_question",
-                notification=Notification(
-                    title="New Question",
-                    body="A new question is now active! \n" + question.text,
-                ),
-            )
-        message = await self.send_message(message)
-        print(f"Message sent: {message}")
-        return message
-        return await self.send_message(message)
-
-    async def send_new_answers_notification(
-        self, notification: Notification = None
-    ) -> str:
-        """
-        Sends a notification to all users waiting for answers that new answers are now available.
-        """
-        if notification is None:
-            notification = Notification(
-                title="New Answers",
-                body="New answers are now available!",
-            )
-        return await self.send_message(
-            Message(
-                topic="new_answers",
-                notification=notification,
-            )
-        )
-
     async def subscribe_to_topic(self, topic: str, tokens: List[str]) -> str:
         """
         Subscribes a list of tokens to a topic.
         """
-        report = messaging.subscribe_to_topic(tokens, topic)
-        print(f'response.success_count: {report.success_count}, response.failure_count: {report.failure_count}')
+        report = await asyncio.to_thread(messaging.subscribe_to_topic, tokens, topic)
+        logger.debug(
+            "Subscribed %d tokens to %s, %d failed",
+            report.success_count,
+            topic,
+            report.failure_count,
+        )
         return report
     
     async def unsubscribe_from_topic(self, topic: str, tokens: List[str]) -> str:
         """
         Unsubscribes a list of tokens from a topic.
         """
-        return messaging.unsubscribe_from_topic(tokens, topic)
\ No newline at end of file
+        return await asyncio.to_thread(messaging.unsubscribe_from_topic, tokens, topic)
+
+
+async def new_question_message(
+    db: AsyncSession, message: Message = None, question_id=None
+) -> Message:
+    """
+    The notification that a new question, the question of the day by default, is now active,
+    unless another message is given.
+    """
+    if message is not None:
+        return message
+    questionCRUD = Question.CRUDQuestion(db, models.Question)
+    if question_id is not None:
+        question = await questionCRUD.get(question_id)
+    else:
+        question = await questionCRUD.get(query_dict={"of_the_day": True})
+    return Message(
+        topic="new_question",
+        notification=Notification(
+            title="New Question",
+            body="A new question is now active! \n" + question.text,
+        ),
+    )
+
+
+# FCM accepts at most this many tokens per topic management call
+TOPIC_BATCH_SIZE = 1000
+# Session.info key of the subscription changes waiting for the session to commit
+PENDING_SUBSCRIPTIONS = "subscription_batcher_pending"
+# Per-token errors of a topic management report that retrying won't fix: the token is malformed
+# or no longer registered, or its app instance is subscribed to too many topics.
+# Other reasons, e.g. INTERNAL or RESOURCE_EXHAUSTED, are transient.
+PERMANENT_TOPIC_ERRORS = {"INVALID_ARGUMENT", "NOT_FOUND", "TOO_MANY_TOPICS"}
+# Failures of a whole topic management call that retrying won't fix, e.g. bad credentials.
+# Others, e.g. unavailable, deadline exceeded or a dropped connection, are transient.
+PERMANENT_CALL_ERRORS = (
+    ValueError,
+    exceptions.InvalidArgumentError,
+    exceptions.NotFoundError,
+    exceptions.PermissionDeniedError,
+    exceptions.UnauthenticatedError,
+)
+
+
+class TopicSubscriptionBatcher:
+    """
+    Pushes topic subscription changes to Firebase in the background, grouped per topic in
+    batches of TOPIC_BATCH_SIZE tokens. The TopicSubscription rows are the source of truth,
+    this only mirrors them to FCM. Tokens failing with a transient error are sent again with
+    the next flush, up to max_attempts times. Permanent failures are dropped.
+    Pending changes are lost on a restart, the rows are reconciled at startup and every
+    reconcile_interval seconds to catch up.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = config.SUBSCRIPTION_FLUSH_INTERVAL,
+        max_attempts: int = config.SUBSCRIPTION_MAX_ATTEMPTS,
+        reconcile_interval: float = config.SUBSCRIPTION_RECONCILE_INTERVAL,
+    ):
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.reconcile_interval = reconcile_interval
+        # (topic, subscribe) -> {token: attempts so far}
+        self._pending: Dict[Tuple[str, bool], Dict[str, int]] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        # Set to have _run flush before the interval is up
+        self._flush_requested = asyncio.Event()
+        self._firebase: Firebase | None = None
+        # metrics
+        self.calls = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.reconciled = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def add(self, topic: str, token: str, subscribe: bool, attempts: int = 0):
+        # The latest change of a token wins
+        self._pending.get((topic, not subscribe), {}).pop(token, None)
+        tokens = self._pending.setdefault((topic, subscribe), {})
+        tokens[token] = attempts
+        if len(tokens) >= TOPIC_BATCH_SIZE:
+            self._flush_requested.set()
+
+    def add_after_commit(
+        self, db: AsyncSession, topic: str, token: str, subscribe: bool
+    ):
+        """
+        Adds the change once db commits the TopicSubscription row it mirrors,
+        and drops it if the session rolls back.
+        """
+        pending = db.info.get(PENDING_SUBSCRIPTIONS)
+        if pending is None:
+            pending = db.info[PENDING_SUBSCRIPTIONS] = []
+            event.listen(db.sync_session, "after_commit", self._after_commit)
+            event.listen(db.sync_session, "after_soft_rollback", self._after_rollback)
+        pending.append((topic, token, subscribe))
+
+    def _after_commit(self, session: Session):
+        pending = session.info[PENDING_SUBSCRIPTIONS]
+        for topic, token, subscribe in pending:
+            self.add(topic, token, subscribe)
+        pending.clear()
+
+    def _after_rollback(self, session: Session, previous_transaction):
+        session.info[PENDING_SUBSCRIPTIONS].clear()
+
+    async def reconcile(self) -> int:
+        """
+        Queues the subscription status of every user with a token from the topic_subscriptions rows.
+        Changes already pending are newer than the rows read, they're kept.
+        Returns the number of changes queued.
+        """
+        subscriptions = models.TopicSubscription.__table__
+        users = models.User.__table__
+        query = (
+            select(
+                subscriptions.c.topic,
+                users.c.firebase_token,
+                subscriptions.c.subscription_status,
+            )
+            .join(users, users.c.id == subscriptions.c.user_id)
+            .where(users.c.firebase_token.is_not(None))
+        )
+        queued = 0
+        async with session_manager.read_session() as db:
+            result = await db.stream(
+                query.execution_options(yield_per=TOPIC_BATCH_SIZE)
+            )
+            async for topic, token, subscribe in result:
+                if any(
+                    token in self._pending.get((topic, subscribed), {})
+                    for subscribed in (True, False)
+                ):
+                    continue
+                self._pending.setdefault((topic, subscribe), {})[token] = 0
+                queued += 1
+        self.reconciled += queued
+        return queued
+
+    async def _reconcile(self):
+        try:
+            queued = await self.reconcile()
+        except Exception as e:
+            logger.warning("Reconciling topic subscriptions failed: %s", e)
+            return
+        logger.info("Reconciled topic subscriptions, %d changes queued", queued)
+
+    async def _send(self, topic: str, subscribe: bool, tokens: List[str]):
+        if self._firebase is None:
+            self._firebase = Firebase()
+        if subscribe:
+            return await self._firebase.subscribe_to_topic(topic=topic, tokens=tokens)
+        return await self._firebase.unsubscribe_from_topic(topic=topic, tokens=tokens)
+
+    async def flush(self):
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            for (topic, subscribe), tokens in pending.items():
+                tokens = list(tokens.items())
+                for i in range(0, len(tokens), TOPIC_BATCH_SIZE):
+                    batch = tokens[i : i + TOPIC_BATCH_SIZE]
+                    self.calls += 1
+                    try:
+                        report = await self._send(
+                            topic, subscribe, [token for token, _ in batch]
+                        )
+                        errors = [
+                            (
+                                error.index,
+                                error.reason,
+                                error.reason in PERMANENT_TOPIC_ERRORS,
+                            )
+                            for error in report.errors
+                        ]
+                    except Exception as e:
+                        logger.warning("Topic subscription batch failed: %s", e)
+                        permanent = isinstance(e, PERMANENT_CALL_ERRORS)
+                        errors = [
+                            (index, type(e).__name__, permanent)
+                            for index in range(len(batch))
+                        ]
+                    self.succeeded += len(batch) - len(errors)
+                    for index, reason, permanent in errors:
+                        token, attempts = batch[index]
+                        if permanent:
+                            self.dropped += 1
+                        elif attempts + 1 < self.max_attempts:
+                            self.retried += 1
+                            self._retry(topic, token, subscribe, attempts + 1)
+                        else:
+                            self.failed += 1
+                    if errors:
+                        reasons = {reason for _, reason, _ in errors}
+                        logger.warning(
+                            "Topic %s: %d tokens failed (%s)",
+                            topic,
+                            len(errors),
+                            ", ".join(sorted(reasons)),
+                        )
+
+    def _retry(self, topic: str, token: str, subscribe: bool, attempts: int):
+        # Unless the token changed again meanwhile
+        if token in self._pending.get((topic, not subscribe), {}):
+            return
+        self._pending.setdefault((topic, subscribe), {}).setdefault(token, attempts)
+
+    async def _run(self):
+        await self._reconcile()
+        reconciled_at = time.monotonic()
+        while True:
+            if (
+                self.reconcile_interval > 0
+                and time.monotonic() - reconciled_at >= self.reconcile_interval
+            ):
+                await self._reconcile()
+                reconciled_at = time.monotonic()
+            try:
+                await asyncio.wait_for(
+                    self._flush_requested.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending": {
+                f"{'subscribe' if subscribe else 'unsubscribe'}:{topic}": len(tokens)
+                for (topic, subscribe), tokens in self._pending.items()
+            },
+            "calls": self.calls,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "reconciled": self.reconciled,
+        }
+
+
+subscription_batcher = TopicSubscriptionBatcher()
@@ -7,6 +7,12 @@ from contextlib import asynccontextmanager
 
 from database import session_manager
 from routers import core, auth, admin
+import audio
+import authentication
+from config import config
+from view_counters import view_buffer
+from notifications import notification_outbox
+from firebase import subscription_batcher
 
 
 def init_app(init_db=True):
@@ -17,7 +23,17 @@ def init_app(init_db=True):
 
         @asynccontextmanager
         async def lifespan(app: FastAPI):
+            session_manager.start()
+            if config.VIEW_BUFFER_ENABLED:
+                view_buffer.start()
+            notification_outbox.start()
+            subscription_batcher.start()
             yield
+            await subscription_batcher.stop()
+            await notification_outbox.stop()
+            await view_buffer.stop()
+            audio.shutdown_executor()
+            authentication.password_pool.shutdown()
             if session_manager._engine is not None:
                 await session_manager.close()
     
@@ -10,8 +10,10 @@ from sqlalchemy import (
     Float,
     types,
     Table,
+    Index,
+    UniqueConstraint,
 )
-from sqlalchemy.dialects.postgresql import UUID, BYTEA, ARRAY
+from sqlalchemy.dialects.postgresql import UUID, BYTEA, ARRAY, JSONB
 from sqlalchemy.orm import relationship, mapped_column, Mapped, deferred
 
 import uuid
@@ -63,11 +65,16 @@ user_answer_views = Table(
         UUID(as_uuid=True),
         ForeignKey("answers.id"),
         primary_key=True,
+        index=True,
     ),
 )
 
 
 class BaseMixin:
+    # Columns generated on INSERT and UPDATE come back with RETURNING in the same statement,
+    # rather than a SELECT when they're first accessed
+    __mapper_args__ = {"eager_defaults": True}
+
     id: Mapped[uuid.UUID] = mapped_column(
         UUID(as_uuid=True),
         primary_key=True,
@@ -88,6 +95,8 @@ class BaseMixin:
 
 class User(BaseMixin, Base):
     __tablename__ = "users"
+    # Keyset pagination of the admin lists
+    __table_args__ = (Index("ix_users_created_at_id", "created_at", "id"),)
     device_id: Mapped[str] = mapped_column(
         unique=True,
         nullable=False,
@@ -147,6 +156,8 @@ class User(BaseMixin, Base):
 
 class Question(BaseMixin, Base):
     __tablename__ = "questions"
+    # Keyset pagination of the admin lists
+    __table_args__ = (Index("ix_questions_created_at_id", "created_at", "id"),)
     text: Mapped[str] = mapped_column(
         nullable=False,
     )
@@ -167,6 +178,12 @@ class Question(BaseMixin, Base):
 
 class Answer(BaseMixin, Base):
     __tablename__ = "answers"
+    # Feed selection filters by question and sorts by views
+    __table_args__ = (
+        Index("ix_answers_question_id_unique_views", "question_id", "unique_views"),
+        # Keyset pagination of the admin lists
+        Index("ix_answers_created_at_id", "created_at", "id"),
+    )
     audio_location: Mapped[uuid.UUID] = mapped_column(
         nullable=False,
     )
@@ -230,6 +247,8 @@ class Answer(BaseMixin, Base):
 
 class Flag(BaseMixin, Base):
     __tablename__ = "flags"
+    # Keyset pagination of the admin lists
+    __table_args__ = (Index("ix_flags_created_at_id", "created_at", "id"),)
     reason: Mapped[str] = mapped_column(
         nullable=True,  # No reason by default
     )
@@ -257,6 +276,12 @@ class Flag(BaseMixin, Base):
 
 class Vote(BaseMixin, Base):
     __tablename__ = "votes"
+    # One vote per user per answer
+    __table_args__ = (
+        UniqueConstraint("answer_id", "user_id", name="votes_answer_id_user_id_key"),
+        # Keyset pagination of the admin lists
+        Index("ix_votes_created_at_id", "created_at", "id"),
+    )
     vote: Mapped[int] = mapped_column(
         nullable=False,
     )
@@ -284,6 +309,8 @@ class Vote(BaseMixin, Base):
 
 class Embedding(BaseMixin, Base):
     __tablename__ = "embeddings"
+    # Keyset pagination of the admin lists
+    __table_args__ = (Index("ix_embeddings_created_at_id", "created_at", "id"),)
     embedding: Mapped[List[float]] = mapped_column(
         ARRAY(Float),
         nullable=False,
@@ -328,6 +355,10 @@ class Test(BaseMixin, Base):
 
 class TestGroup(BaseMixin, Base):
     __tablename__ = "test_groups"
+    # One version per user per test
+    __table_args__ = (
+        UniqueConstraint("test_id", "user_id", name="test_groups_test_id_user_id_key"),
+    )
     test_id: Mapped[uuid.UUID] = mapped_column(
         ForeignKey("tests.id"),
         nullable=False,
@@ -373,3 +404,45 @@ class TopicSubscription(BaseMixin, Base):
         back_populates="topic_subscriptions",
         lazy="selectin",
     )
+
+
+# Push notifications to send, written in the same transaction as the change triggering them
+# and drained by notifications.NotificationOutbox
+class NotificationOutbox(BaseMixin, Base):
+    __tablename__ = "notification_outbox"
+    # schemas.Message
+    payload: Mapped[dict] = mapped_column(
+        JSONB,
+        nullable=False,
+    )
+    # Pending messages with the same key are sent as one
+    collapse_key: Mapped[Optional[str]] = mapped_column(
+        nullable=True,
+    )
+    # pending, sending, sent, or dead once out of attempts
+    status: Mapped[str] = mapped_column(
+        nullable=False,
+        default="pending",
+    )
+    attempts: Mapped[int] = mapped_column(
+        nullable=False,
+        default=0,
+    )
+    next_attempt_at: Mapped[datetime] = mapped_column(
+        nullable=False,
+        default=datetime.utcnow,
+    )
+    last_error: Mapped[Optional[str]] = mapped_column(
+        nullable=True,
+    )
+    sent_at: Mapped[Optional[datetime]] = mapped_column(
+        nullable=True,
+    )
+
+    __table_args__ = (
+        Index(
+            "ix_notification_outbox_status_next_attempt_at",
+            "status",
+            "next_attempt_at",
+        ),
+    )
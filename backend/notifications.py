@@ -0,0 +1,361 @@
+# Durable delivery of push notifications through the notification_outbox table
+# Messages are added to the outbox in the same transaction as the change triggering them, and
+# NotificationOutbox workers, on any number of nodes, claim them with SELECT ... FOR UPDATE SKIP LOCKED.
+# The transport is pluggable, FakeTransport records messages instead of calling FCM.
+
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Protocol, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from config import config
+from database import session_manager
+from schemas import Message, Notification
+
+
+class Transport(Protocol):
+    async def send(self, message: Message) -> str: ...
+
+
+class FirebaseTransport:
+    """
+    Sends through Firebase Cloud Messaging. The Firebase app is initialized on the first send.
+    """
+
+    def __init__(self):
+        self._firebase = None
+
+    async def send(self, message: Message) -> str:
+        if self._firebase is None:
+            from firebase import Firebase
+
+            self._firebase = Firebase()
+        return await self._firebase.send_message(message)
+
+
+class FakeTransport:
+    """
+    Local stand-in for FCM, keeps the sent messages. Fails every send while fail is set.
+    """
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.messages: List[Message] = []
+
+    async def send(self, message: Message) -> str:
+        if self.fail:
+            raise RuntimeError("Fake transport failure")
+        self.messages.append(message)
+        return f"fake-{len(self.messages)}"
+
+
+def new_answers_message(notification: Notification = None, count: int = 1) -> Message:
+    """
+    The notification that new answers are now available, count of them if collapsed.
+    """
+    if notification is None:
+        notification = Notification(
+            title="New Answers",
+            body=(
+                "New answers are now available!"
+                if count == 1
+                else f"{count} new answers are now available!"
+            ),
+        )
+    return Message(
+        topic="new_answers",
+        notification=notification,
+    )
+
+
+# Messages replacing several pending ones of a collapse key, from their count.
+# Keys without a builder send the latest pending message.
+COLLAPSED_MESSAGES: Dict[str, Callable[[int], Message]] = {
+    "new_answers": lambda count: new_answers_message(count=count),
+}
+
+
+def add_notification(
+    db: AsyncSession,
+    message: Message,
+    collapse_key: Optional[str] = None,
+    delay: float = 0,
+):
+    """
+    Adds a message to the outbox, it's written with the session's next commit.
+    Sending is delayed by delay seconds, during which further messages of the same
+    collapse_key are collected and sent along as one, early once the outbox worker
+    finds coalesce_threshold of them pending.
+    """
+    db.add(
+        models.NotificationOutbox(
+            payload=message.model_dump(mode="json", exclude_none=True),
+            collapse_key=collapse_key,
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+        )
+    )
+
+
+def backoff_delay(attempts: int, base: float, maximum: float) -> float:
+    """
+    Seconds to wait before the next attempt, doubling with each failed one.
+    """
+    return min(base * 2 ** (attempts - 1), maximum)
+
+
+class NotificationOutbox:
+    def __init__(
+        self,
+        transport: Optional[Transport] = None,
+        poll_interval: float = config.OUTBOX_POLL_INTERVAL,
+        batch_size: int = config.OUTBOX_BATCH_SIZE,
+        max_attempts: int = config.OUTBOX_MAX_ATTEMPTS,
+        backoff_base: float = config.OUTBOX_BACKOFF_BASE,
+        backoff_max: float = config.OUTBOX_BACKOFF_MAX,
+        lease: float = config.OUTBOX_LEASE,
+        concurrency: int = config.NOTIFICATION_WORKERS,
+        coalesce_threshold: int = config.NOTIFICATION_COALESCE_THRESHOLD,
+    ):
+        self.transport = transport or FirebaseTransport()
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Claimed messages not sent or failed within this many seconds are claimed again,
+        # e.g. when their worker died
+        self.lease = lease
+        self.concurrency = concurrency
+        # Pending messages of a collapse key are sent without waiting out their delay
+        # once there are this many, 0 always waits
+        self.coalesce_threshold = coalesce_threshold
+        self._task: asyncio.Task | None = None
+        # metrics
+        self.claimed = 0
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def _lease(self, ids, until: datetime):
+        # Every claim counts as an attempt, so that a message crashing or hanging its worker
+        # isn't claimed again forever
+        outbox = models.NotificationOutbox.__table__
+        return (
+            update(outbox)
+            .where(outbox.c.id.in_(ids))
+            .values(
+                status="sending",
+                attempts=outbox.c.attempts + 1,
+                next_attempt_at=until,
+                updated_at=datetime.utcnow(),
+            )
+            .returning(
+                outbox.c.id, outbox.c.payload, outbox.c.collapse_key, outbox.c.attempts
+            )
+        )
+
+    async def release_coalesced(self, db: AsyncSession):
+        """
+        Makes the pending messages of collapse keys with coalesce_threshold of them due now.
+        """
+        if self.coalesce_threshold <= 0:
+            return
+        outbox = models.NotificationOutbox.__table__
+        now = datetime.utcnow()
+        crowded = (
+            select(outbox.c.collapse_key)
+            .where(outbox.c.status == "pending")
+            .where(outbox.c.collapse_key.is_not(None))
+            .group_by(outbox.c.collapse_key)
+            .having(func.count() >= self.coalesce_threshold)
+        )
+        await db.execute(
+            update(outbox)
+            .where(outbox.c.status == "pending")
+            .where(outbox.c.next_attempt_at > now)
+            .where(outbox.c.collapse_key.in_(crowded))
+            .values(next_attempt_at=now, updated_at=now)
+        )
+
+    async def claim(self, db: AsyncSession) -> List:
+        """
+        Claims due messages, and the pending ones sharing their collapse keys, for lease seconds.
+        Rows locked by other workers are skipped rather than waited for.
+        Due messages out of attempts, e.g. whose leases kept expiring, are moved to the dead state.
+        """
+        outbox = models.NotificationOutbox.__table__
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=self.lease)
+        due = (outbox.c.status.in_(["pending", "sending"])) & (
+            outbox.c.next_attempt_at <= now
+        )
+        expired = (
+            select(outbox.c.id)
+            .where(due)
+            .where(outbox.c.attempts >= self.max_attempts)
+            .with_for_update(skip_locked=True)
+        )
+        dead = await db.execute(
+            update(outbox)
+            .where(outbox.c.id.in_(expired))
+            .values(
+                status="dead",
+                last_error=func.coalesce(outbox.c.last_error, "Lease expired"),
+                updated_at=now,
+            )
+        )
+        self.dead += dead.rowcount
+        claimable = (
+            select(outbox.c.id)
+            .where(due)
+            .where(outbox.c.attempts < self.max_attempts)
+            .order_by(outbox.c.next_attempt_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        rows = (await db.execute(self._lease(claimable, until))).all()
+        keys = {row.collapse_key for row in rows if row.collapse_key is not None}
+        if keys:
+            collapsed = (
+                select(outbox.c.id)
+                .where(outbox.c.status == "pending")
+                .where(outbox.c.collapse_key.in_(keys))
+                .with_for_update(skip_locked=True)
+            )
+            rows += (await db.execute(self._lease(collapsed, until))).all()
+        await db.commit()
+        self.claimed += len(rows)
+        return rows
+
+    async def deliver(self, rows: List) -> Tuple[List, List[Tuple]]:
+        """
+        Sends the claimed rows, one message per collapse key.
+        Returns the ids of the sent rows and the failed rows with their errors.
+        """
+        groups: Dict[object, List] = {}
+        for row in rows:
+            groups.setdefault(row.collapse_key or row.id, []).append(row)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        sent_ids = []
+        failures = []
+
+        async def _send(key, group: List):
+            builder = COLLAPSED_MESSAGES.get(key)
+            if builder is not None and len(group) > 1:
+                message = builder(len(group))
+            else:
+                message = Message.model_validate(group[-1].payload)
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await self.transport.send(message)
+                except Exception as e:
+                    print(f"Sending notification failed: {e}")
+                    failures.extend((row, str(e)) for row in group)
+                    return
+            latency = time.perf_counter() - start
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.sent += 1
+            sent_ids.extend(row.id for row in group)
+
+        await asyncio.gather(*[_send(key, group) for key, group in groups.items()])
+        return sent_ids, failures
+
+    async def record(self, db: AsyncSession, sent_ids: List, failures: List[Tuple]):
+        """
+        Marks sent rows, and schedules failed ones again with exponential backoff,
+        or moves them to the dead state after max_attempts.
+        """
+        outbox = models.NotificationOutbox.__table__
+        now = datetime.utcnow()
+        if sent_ids:
+            await db.execute(
+                update(outbox)
+                .where(outbox.c.id.in_(sent_ids))
+                .values(status="sent", sent_at=now, updated_at=now)
+            )
+        for row, error in failures:
+            # Counted when claimed
+            attempts = row.attempts
+            values = {"last_error": error, "updated_at": now}
+            if attempts >= self.max_attempts:
+                self.dead += 1
+                values["status"] = "dead"
+            else:
+                self.failed += 1
+                values["status"] = "pending"
+                values["next_attempt_at"] = now + timedelta(
+                    seconds=backoff_delay(attempts, self.backoff_base, self.backoff_max)
+                )
+            await db.execute(
+                update(outbox).where(outbox.c.id == row.id).values(**values)
+            )
+        await db.commit()
+
+    async def drain_once(self) -> int:
+        async with session_manager.session() as db:
+            # Committed along with the claim
+            await self.release_coalesced(db)
+            rows = await self.claim(db)
+            if not rows:
+                return 0
+            sent_ids, failures = await self.deliver(rows)
+            await self.record(db, sent_ids, failures)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                claimed = await self.drain_once()
+            except Exception as e:
+                print(f"Draining the notification outbox failed: {e}")
+                claimed = 0
+            # Keep going without sleeping while there's a backlog
+            if claimed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # Claimed rows left unsent are picked up again once their lease expires
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def counts(self, db: AsyncSession) -> Dict[str, int]:
+        outbox = models.NotificationOutbox.__table__
+        result = await db.execute(
+            select(outbox.c.status, func.count()).group_by(outbox.c.status)
+        )
+        return dict(result.all())
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "claimed": self.claimed,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dead": self.dead,
+            "avg_latency": self.total_latency / self.sent if self.sent else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+
+notification_outbox = NotificationOutbox()
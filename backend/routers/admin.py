@@ -21,12 +21,19 @@ import time
 import random
 
 import models, schemas
-from database import get_db
+from database import get_db, get_read_db, get_uow_db, session_manager
 import authentication
+import audio
 from config import config
-from CRUD.Object import check_related_object
+from CRUD.Object import bulk_update, check_related_object
+from CRUD.Pagination import list_response
+from CRUD.Profiles import profile_options
 from CRUD import TestGroup, Test, Question, User
-from firebase import Firebase
+from firebase import new_question_message, subscription_batcher
+from notifications import add_notification, notification_outbox
+from view_counters import view_buffer
+from auth_cache import principal_cache
+from experiments import experiment_registry
 
 
 class Message(BaseModel):
@@ -48,7 +55,7 @@ router = APIRouter(
 )
 async def create_admin(
     user: schemas.UserCreateModel,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
     password: str = Query(...),
 ):
     if password != config.ADMIN_SECRET:
@@ -70,7 +77,6 @@ async def create_admin(
     out_user = await authentication.register_user(user, db)
     out_user.is_admin = True
     await db.commit()
-    await db.refresh(out_user)
 
     for field in out_user.__table__.columns:
         print(f"{field.name}: {getattr(out_user, field.name)}")
@@ -79,69 +85,73 @@ async def create_admin(
     return out_user
 
 
-@router.post("/users", response_model=List[schemas.UserUpdateAdminModel])
+@router.post("/users", response_model=schemas.UserBulkRegistrationModel)
 async def register_users(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     users: List[schemas.UserCreateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
-    # Create user in database
-    out_users = []
-    for user in users:
-        out_user = await authentication.register_user(user, db)
-        out_users.append(out_user)
+    # Create users in database, in one transaction
+    out_users, conflicts = await authentication.register_users_bulk(users, db)
 
     # Convert to external model
-    out_users = [schemas.UserUpdateAdminModel.model_validate(user)]
-    return out_users
+    out_users = [
+        schemas.UserUpdateAdminModel.model_validate(user) for user in out_users
+    ]
+    await db.commit()
+    return schemas.UserBulkRegistrationModel(users=out_users, conflicts=conflicts)
 
 
 @router.get("/users", response_model=List[schemas.UserUpdateAdminModel])
 async def get_users(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
     ids: Optional[List[uuid.UUID]] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(config.ADMIN_PAGE_SIZE, ge=1, le=config.ADMIN_MAX_PAGE_SIZE),
+    # Every user after cursor as NDJSON, rather than a page
+    stream: bool = Query(False),
 ):
-    # Get users from database
-    query = select(models.User)
+    # Get users from database, a page at a time
+    query = select(models.User).options(*profile_options(models.User, "admin-list"))
 
     if ids is not None:
         query = query.where(models.User.id.in_(ids))
 
-    users = await db.execute(query)
-    users = users.unique().scalars().all()
-
-    if users is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No users found",
-        )
-
     # Convert to external model
-    users = [schemas.UserUpdateAdminModel.model_validate(user) for user in users]
-    return users
+    async def to_external(users):
+        return [schemas.UserUpdateAdminModel.model_validate(user) for user in users]
+
+    return await list_response(
+        db, response, query, models.User, cursor, limit, stream, to_external
+    )
 
 
 @router.patch("/users", response_model=List[schemas.UserUpdateAdminModel])
 async def update_users(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     users: List[schemas.UserUpdateAdminModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
-    # Update users in database
-    out_users = []
-    db_users = await db.execute(
-        select(models.User).where(models.User.id.in_([user.id for user in users]))
-    )
-    db_users = db_users.unique().scalars().all()
-    for db_user, user in zip(db_users, users):
-        for field in user.model_fields:
-            setattr(db_user, field, getattr(user, field))
-        out_users.append(db_user)
+    # Update users in database, only the fields set on each
+    rows = [user.model_dump(exclude_unset=True) for user in users]
+    for row in rows:
+        password = row.pop("password", None)
+        if password is not None:
+            row["password"] = await authentication.get_password_hash(
+                password.get_secret_value()
+            )
+    out_users = await bulk_update(models.User, rows, db)
     await db.commit()
-
     for user in out_users:
-        await db.refresh(user)
+        principal_cache.invalidate(user.id)
 
     # Convert to external model
     out_users = [
@@ -152,16 +162,17 @@ async def update_users(
 
 @router.post("/questions", response_model=List[schemas.QuestionUpdateModel])
 async def submit_questions(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     questions: List[schemas.QuestionCreateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     # Create questions in database
     db_questions = [models.Question(**question.model_dump()) for question in questions]
     db.add_all(db_questions)
     await db.commit()
     for question in db_questions:
-        await db.refresh(question)
         print(f"Question: {question}")
         for field in question.__table__.columns:
             print(f"{field.name}: {getattr(question, field.name)}")
@@ -176,55 +187,53 @@ async def submit_questions(
 
 @router.get("/questions", response_model=List[schemas.QuestionUpdateModel])
 async def get_questions(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
-    ids: List[uuid.UUID] = Query(None),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
+    ids: Optional[List[uuid.UUID]] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(config.ADMIN_PAGE_SIZE, ge=1, le=config.ADMIN_MAX_PAGE_SIZE),
+    # Every question after cursor as NDJSON, rather than a page
+    stream: bool = Query(False),
 ):
-    # Get questions from database
-    query = select(models.Question)
+    # Get questions from database, a page at a time
+    query = select(models.Question).options(
+        *profile_options(models.Question, "admin-list")
+    )
 
     if ids is not None:
         query = query.where(models.Question.id.in_(ids))
 
-    questions = await db.execute(query)
-    questions = questions.unique().scalars().all()
-
-    if questions is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No questions found",
-        )
-
     # Convert to external model
-    questions = [
-        schemas.QuestionUpdateModel.model_validate(question) for question in questions
-    ]
-    return questions
+    async def to_external(questions):
+        return [
+            schemas.QuestionUpdateModel.model_validate(question)
+            for question in questions
+        ]
+
+    return await list_response(
+        db, response, query, models.Question, cursor, limit, stream, to_external
+    )
 
 
 @router.patch("/questions", response_model=List[schemas.QuestionUpdateModel])
 async def update_questions(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     questions: List[schemas.QuestionUpdateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
-    # Update questions in database
-    out_questions = []
-    db_questions = await db.execute(
-        select(models.Question).where(
-            models.Question.id.in_([question.id for question in questions])
-        )
+    # Update questions in database, only the fields set on each
+    out_questions = await bulk_update(
+        models.Question,
+        [question.model_dump(exclude_unset=True) for question in questions],
+        db,
     )
-    db_questions = db_questions.unique().scalars().all()
-    for db_question, question in zip(db_questions, questions):
-        for field in question.model_fields:
-            setattr(db_question, field, getattr(question, field))
-        out_questions.append(db_question)
     await db.commit()
 
-    for question in out_questions:
-        await db.refresh(question)
-
     # Convert to external model
     out_questions = [
         schemas.QuestionUpdateModel.model_validate(question)
@@ -235,9 +244,11 @@ async def update_questions(
 
 @router.post("/answers", response_model=List[schemas.AnswerUpdateModel])
 async def submit_answers(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     answers: List[schemas.AnswerCreateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     db_answers = []
     for answer in answers:
@@ -249,8 +260,7 @@ async def submit_answers(
         # Save the audio data to audio_files, provided as bytes
         audio_data = answer.audio_data
         audio_location = uuid.uuid4()
-        with open(f"{config.AUDIO_FILE_PATH}{audio_location}.wav", "wb") as f:
-            f.write(audio_data)
+        await audio.write_audio(audio_location, audio_data)
         # Create the answer
         obj_in_data = answer.model_dump()
         db_answer = models.Answer(**obj_in_data)
@@ -258,11 +268,11 @@ async def submit_answers(
         db_answer.author = user
         db_answer.question = question
         db_answer.audio_location = audio_location
+        # A new answer has no viewers, so they aren't loaded after the insert
+        db_answer.viewed_by = []
         db_answers.append(db_answer)
     db.add_all(db_answers)
     await db.commit()
-    for answer in db_answers:
-        await db.refresh(answer)
     return [
         schemas.AnswerUpdateModel.model_validate(
             {**answer.__dict__, "audio_data": audio_data}
@@ -275,98 +285,114 @@ async def submit_answers(
 
 @router.get("/answers", response_model=List[schemas.AnswerUpdateModel])
 async def get_answers(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
     ids: Optional[List[uuid.UUID]] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(config.ADMIN_PAGE_SIZE, ge=1, le=config.ADMIN_MAX_PAGE_SIZE),
+    # Every answer after cursor as NDJSON, rather than a page
+    stream: bool = Query(False),
+    # Audio files are only read when asked for
+    with_audio: bool = Query(False),
 ):
-    # Get answers from database
-    query = select(models.Answer)
+    # Get answers from database, a page at a time
+    query = select(models.Answer).options(*profile_options(models.Answer, "admin-list"))
 
     if ids is not None:
         query = query.where(models.Answer.id.in_(ids))
 
-    answers = await db.execute(query)
-    answers = answers.unique().scalars().all()
-
-    if answers is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No answers found",
-        )
-
-    # Get the audio data
-    answers_audio_data = []
-    for answer in answers:
-        audio_data = None
-        with open(f"{config.AUDIO_FILE_PATH}{answer.audio_location}", "rb") as f:
-            audio_data = f.read()
-        answers_audio_data.append((answer, audio_data))
-
-    # Convert to external model
-    answers = [
-        schemas.AnswerUpdateModel.model_validate(
-            {**answer.__dict__, "audio_data": audio_data}
-        )
-        for answer, audio_data in answers_audio_data
-    ]
-    return answers
+    # Convert to external model, with the audio data of the batch
+    async def to_external(answers):
+        audio_data = [None] * len(answers)
+        if with_audio:
+            reads = await audio.read_audio_batch(
+                [answer.audio_location for answer in answers]
+            )
+            audio_data = [read.audio_data for read in reads]
+        return [
+            schemas.AnswerUpdateModel.model_validate(
+                {**answer.__dict__, "audio_data": data}
+            )
+            for answer, data in zip(answers, audio_data)
+        ]
+
+    return await list_response(
+        db, response, query, models.Answer, cursor, limit, stream, to_external
+    )
 
 
 @router.patch("/answers", response_model=List[schemas.AnswerUpdateModel])
 async def update_answers(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     answers: List[schemas.AnswerUpdateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
-    # Update answers in database
-    out_answers = []
-    db_answers = await db.execute(
-        select(models.Answer).where(
+    # Current audio of the answers, unknown ids aren't updated and get no file written
+    result = await db.execute(
+        select(models.Answer.id, models.Answer.audio_location).where(
             models.Answer.id.in_([answer.id for answer in answers])
         )
     )
-    db_answers = db_answers.unique().scalars().all()
-    for db_answer, answer in zip(db_answers, answers):
-        for field in answer.model_fields:
-            if field == "audio_data":
-                audio_location = uuid.uuid4()
-                with open(f"{config.AUDIO_FILE_PATH}{audio_location}.wav", "wb") as f:
-                    f.write(answer.audio_data)
-                setattr(db_answer, "audio_location", audio_location)
-            else:
-                setattr(db_answer, field, getattr(answer, field))
-        out_answers.append(db_answer)
-    await db.commit()
-
-    answers_audio_data = []
-    for answer in out_answers:
-        await db.refresh(answer)
-        audio_data = None
-        with open(f"{config.AUDIO_FILE_PATH}{answer.audio_location}", "rb") as f:
-            audio_data = f.read()
-        answers_audio_data.append((answer, audio_data))
+    current_locations = dict(result.all())
+    # Update answers in database, only the fields set on each
+    rows = []
+    # answer id -> new audio file, deleted again if the update doesn't go through
+    written = {}
+    try:
+        for answer in answers:
+            if answer.id not in current_locations:
+                continue
+            row = answer.model_dump(exclude_unset=True)
+            # New audio is saved to a new file, the previous one is no longer served
+            if row.pop("audio_data", None) is not None:
+                row["audio_location"] = uuid.uuid4()
+                await audio.write_audio(row["audio_location"], answer.audio_data)
+                # A repeated id keeps its last audio, see bulk_update
+                if answer.id in written:
+                    await audio.delete_audio(written[answer.id])
+                written[answer.id] = row["audio_location"]
+            rows.append(row)
+        out_answers = await bulk_update(models.Answer, rows, db)
+        await db.commit()
+    except Exception:
+        for audio_location in written.values():
+            await audio.delete_audio(audio_location)
+        raise
+    # The cached bytes of the replaced files are stale
+    for id in written:
+        audio.audio_cache.invalidate(current_locations[id])
+
+    reads = await audio.read_audio_batch(
+        [answer.audio_location for answer in out_answers]
+    )
 
     # Convert to external model
-    out_answers = [
+    return [
         schemas.AnswerUpdateModel.model_validate(
-            {**answer.__dict__, "audio_data": audio_data}
+            {**answer._mapping, "audio_data": read.audio_data}
         )
-        for answer, audio_data in answers_audio_data
+        for answer, read in zip(out_answers, reads)
     ]
 
 
 @router.post("/flags", response_model=List[schemas.FlagUpdateModel])
 async def submit_flags(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     flags: List[schemas.FlagCreateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     # Create flags in database
     db_flags = [models.Flag(**flag.model_dump()) for flag in flags]
     db.add_all(db_flags)
     await db.commit()
     for flag in db_flags:
-        await db.refresh(flag)
         print(f"Flag: {flag}")
         for field in flag.__table__.columns:
             print(f"{field.name}: {getattr(flag, field.name)}")
@@ -378,51 +404,46 @@ async def submit_flags(
 
 @router.get("/flags", response_model=List[schemas.FlagUpdateModel])
 async def get_flags(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
     ids: Optional[List[uuid.UUID]] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(config.ADMIN_PAGE_SIZE, ge=1, le=config.ADMIN_MAX_PAGE_SIZE),
+    # Every flag after cursor as NDJSON, rather than a page
+    stream: bool = Query(False),
 ):
-    # Get flags from database
-    query = select(models.Flag)
+    # Get flags from database, a page at a time
+    query = select(models.Flag).options(*profile_options(models.Flag, "admin-list"))
 
     if ids is not None:
         query = query.where(models.Flag.id.in_(ids))
 
-    flags = await db.execute(query)
-    flags = flags.unique().scalars().all()
-
-    if flags is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No flags found",
-        )
-
     # Convert to external model
-    flags = [schemas.FlagUpdateModel.model_validate(flag) for flag in flags]
-    return flags
+    async def to_external(flags):
+        return [schemas.FlagUpdateModel.model_validate(flag) for flag in flags]
+
+    return await list_response(
+        db, response, query, models.Flag, cursor, limit, stream, to_external
+    )
 
 
 @router.patch("/flags", response_model=List[schemas.FlagUpdateModel])
 async def update_flags(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     flags: List[schemas.FlagUpdateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
-    # Update flags in database
-    out_flags = []
-    db_flags = await db.execute(
-        select(models.Flag).where(models.Flag.id.in_([flag.id for flag in flags]))
+    # Update flags in database, only the fields set on each
+    out_flags = await bulk_update(
+        models.Flag, [flag.model_dump(exclude_unset=True) for flag in flags], db
     )
-    db_flags = db_flags.unique().scalars().all()
-    for db_flag, flag in zip(db_flags, flags):
-        for field in flag.model_fields:
-            setattr(db_flag, field, getattr(flag, field))
-        out_flags.append(db_flag)
     await db.commit()
 
-    for flag in out_flags:
-        await db.refresh(flag)
-
     # Convert to external model
     out_flags = [schemas.FlagUpdateModel.model_validate(flag) for flag in out_flags]
     return out_flags
@@ -430,16 +451,17 @@ async def update_flags(
 
 @router.post("/votes", response_model=List[schemas.VoteUpdateModel])
 async def submit_votes(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     votes: List[schemas.VoteCreateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     # Create votes in database
     db_votes = [models.Vote(**vote.model_dump()) for vote in votes]
     db.add_all(db_votes)
     await db.commit()
     for vote in db_votes:
-        await db.refresh(vote)
         print(f"Vote: {vote}")
         for field in vote.__table__.columns:
             print(f"{field.name}: {getattr(vote, field.name)}")
@@ -451,51 +473,46 @@ async def submit_votes(
 
 @router.get("/votes", response_model=List[schemas.VoteUpdateModel])
 async def get_votes(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
     ids: Optional[List[uuid.UUID]] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(config.ADMIN_PAGE_SIZE, ge=1, le=config.ADMIN_MAX_PAGE_SIZE),
+    # Every vote after cursor as NDJSON, rather than a page
+    stream: bool = Query(False),
 ):
-    # Get votes from database
-    query = select(models.Vote)
+    # Get votes from database, a page at a time
+    query = select(models.Vote).options(*profile_options(models.Vote, "admin-list"))
 
     if ids is not None:
         query = query.where(models.Vote.id.in_(ids))
 
-    votes = await db.execute(query)
-    votes = votes.unique().scalars().all()
-
-    if votes is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No votes found",
-        )
-
     # Convert to external model
-    votes = [schemas.VoteUpdateModel.model_validate(vote) for vote in votes]
-    return votes
+    async def to_external(votes):
+        return [schemas.VoteUpdateModel.model_validate(vote) for vote in votes]
+
+    return await list_response(
+        db, response, query, models.Vote, cursor, limit, stream, to_external
+    )
 
 
 @router.patch("/votes", response_model=List[schemas.VoteUpdateModel])
 async def update_votes(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     votes: List[schemas.VoteUpdateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
-    # Update votes in database
-    out_votes = []
-    db_votes = await db.execute(
-        select(models.Vote).where(models.Vote.id.in_([vote.id for vote in votes]))
+    # Update votes in database, only the fields set on each
+    out_votes = await bulk_update(
+        models.Vote, [vote.model_dump(exclude_unset=True) for vote in votes], db
     )
-    db_votes = db_votes.unique().scalars().all()
-    for db_vote, vote in zip(db_votes, votes):
-        for field in vote.model_fields:
-            setattr(db_vote, field, getattr(vote, field))
-        out_votes.append(db_vote)
     await db.commit()
 
-    for vote in out_votes:
-        await db.refresh(vote)
-
     # Convert to external model
     out_votes = [schemas.VoteUpdateModel.model_validate(vote) for vote in out_votes]
     return out_votes
@@ -503,9 +520,11 @@ async def update_votes(
 
 @router.post("/embeddings", response_model=List[schemas.EmbeddingUpdateModel])
 async def submit_embeddings(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     embeddings: List[schemas.EmbeddingCreateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     # Create embeddings in database
     db_embeddings = [
@@ -514,7 +533,6 @@ async def submit_embeddings(
     db.add_all(db_embeddings)
     await db.commit()
     for embedding in db_embeddings:
-        await db.refresh(embedding)
         print(f"Embedding: {embedding}")
         for field in embedding.__table__.columns:
             print(f"{field.name}: {getattr(embedding, field.name)}")
@@ -529,56 +547,53 @@ async def submit_embeddings(
 
 @router.get("/embeddings", response_model=List[schemas.EmbeddingUpdateModel])
 async def get_embeddings(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
     ids: Optional[List[uuid.UUID]] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(config.ADMIN_PAGE_SIZE, ge=1, le=config.ADMIN_MAX_PAGE_SIZE),
+    # Every embedding after cursor as NDJSON, rather than a page
+    stream: bool = Query(False),
 ):
-    # Get embeddings from database
-    query = select(models.Embedding)
+    # Get embeddings from database, a page at a time
+    query = select(models.Embedding).options(
+        *profile_options(models.Embedding, "admin-list")
+    )
 
     if ids is not None:
         query = query.where(models.Embedding.id.in_(ids))
 
-    embeddings = await db.execute(query)
-    embeddings = embeddings.unique().scalars().all()
-
-    if embeddings is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No embeddings found",
-        )
-
     # Convert to external model
-    embeddings = [
-        schemas.EmbeddingUpdateModel.model_validate(embedding)
-        for embedding in embeddings
-    ]
-    return embeddings
+    async def to_external(embeddings):
+        return [
+            schemas.EmbeddingUpdateModel.model_validate(embedding)
+            for embedding in embeddings
+        ]
+
+    return await list_response(
+        db, response, query, models.Embedding, cursor, limit, stream, to_external
+    )
 
 
 @router.patch("/embeddings", response_model=List[schemas.EmbeddingUpdateModel])
 async def update_embeddings(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     embeddings: List[schemas.EmbeddingUpdateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
-    # Update embeddings in database
-    out_embeddings = []
-    db_embeddings = await db.execute(
-        select(models.Embedding).where(
-            models.Embedding.id.in_([embedding.id for embedding in embeddings])
-        )
+    # Update embeddings in database, only the fields set on each
+    out_embeddings = await bulk_update(
+        models.Embedding,
+        [embedding.model_dump(exclude_unset=True) for embedding in embeddings],
+        db,
     )
-    db_embeddings = db_embeddings.unique().scalars().all()
-    for db_embedding, embedding in zip(db_embeddings, embeddings):
-        for field in embedding.model_fields:
-            setattr(db_embedding, field, getattr(embedding, field))
-        out_embeddings.append(db_embedding)
     await db.commit()
 
-    for embedding in out_embeddings:
-        await db.refresh(embedding)
-
     # Convert to external model
     out_embeddings = [
         schemas.EmbeddingUpdateModel.model_validate(embedding)
@@ -589,7 +604,9 @@ async def update_embeddings(
 
 @router.post("/tests", response_model=List[schemas.TestUpdateModel])
 async def submit_tests(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     tests: List[schemas.TestCreateModel],
     db: AsyncSession = Depends(get_db),
 ):
@@ -611,14 +628,17 @@ async def submit_tests(
                     detail=f"Error creating test {test.name}",
                 )
         tests_out.append(schemas.TestUpdateModel.model_validate(db_test))
+    await experiment_registry.refresh(db)
 
     return tests_out
 
 
 @router.get("/tests", response_model=List[schemas.TestUpdateModel])
 async def get_tests(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    db: AsyncSession = Depends(get_read_db),
     ids: List[uuid.UUID] = Query(None),
 ):
     test_CRUD = Test.CRUDTest(db, models.Test)
@@ -626,16 +646,18 @@ async def get_tests(
 
     if ids is not None:
         kwargs["id"] = ids
-    tests = await test_CRUD.get_multi(**kwargs)
+    tests = await test_CRUD.get_multi(profile="admin-list", **kwargs)
     tests = [schemas.TestUpdateModel.model_validate(test) for test in tests]
     return tests
 
 
 @router.post("/test_groups", response_model=List[schemas.TestGroupUpdateModel])
 async def submit_test_groups(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     test_groups: List[schemas.TestGroupCreateModel],
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     test_group_CRUD = TestGroup.CRUDTestGroup(db, models.TestGroup)
     test_groups_out = []
@@ -649,13 +671,16 @@ async def submit_test_groups(
         schemas.TestGroupUpdateModel.model_validate(test_group)
         for test_group in test_groups_out
     ]
+    await db.commit()
     return test_groups_out
 
 
 @router.get("/test_groups", response_model=List[schemas.TestGroupUpdateModel])
 async def get_test_groups(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
-    db: AsyncSession = Depends(get_db),
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    db: AsyncSession = Depends(get_read_db),
     ids: List[uuid.UUID] = Query(None),
 ):
     test_group_CRUD = TestGroup.CRUDTestGroup(db, models.TestGroup)
@@ -663,7 +688,7 @@ async def get_test_groups(
 
     if ids is not None:
         kwargs["id"] = ids
-    test_groups = await test_group_CRUD.get_multi(**kwargs)
+    test_groups = await test_group_CRUD.get_multi(profile="admin-list", **kwargs)
     test_groups = [
         schemas.TestGroupUpdateModel.model_validate(test_group)
         for test_group in test_groups
@@ -673,18 +698,90 @@ async def get_test_groups(
 
 @router.post("/change_question_of_the_day")
 async def change_question_of_the_day(
-    admin: Annotated[models.User, Depends(authentication.get_current_active_admin)],
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
     question_id: uuid.UUID,
     send_notification: bool = True,
     message: Optional[schemas.Message] = None,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     question_CRUD = Question.CRUDQuestion(db, models.Question)
+    # Send notification, through the outbox committed with the change
+    if send_notification:
+        add_notification(
+            db, await new_question_message(db, message, question_id=question_id)
+        )
     # Set the question of the day
     await question_CRUD.set_of_the_day(question_id)
-    # Send notification
-    if send_notification:
-        firebase = Firebase()
-        await firebase.send_new_question_notification(db=db, message=message)
 
+    await db.commit()
     return {"message": "Question of the day changed"}
+
+
+@router.get("/audio_cache")
+async def get_audio_cache_stats(
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+):
+    return {**audio.audio_cache.stats(), **audio.read_stats.stats()}
+
+
+@router.get("/view_buffer")
+async def get_view_buffer_stats(
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+):
+    return view_buffer.stats()
+
+
+@router.get("/auth_cache")
+async def get_auth_cache_stats(
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+):
+    return principal_cache.stats()
+
+
+@router.get("/password_pool")
+async def get_password_pool_stats(
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+):
+    return authentication.password_pool.stats()
+
+
+@router.get("/experiments")
+async def get_experiments_stats(
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+):
+    return experiment_registry.stats()
+
+
+@router.get("/database")
+async def get_database_stats(
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+):
+    return session_manager.pool_stats()
+
+
+@router.get("/notifications")
+async def get_notifications_stats(
+    admin: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_admin)
+    ],
+    db: AsyncSession = Depends(get_db),
+):
+    return {
+        **notification_outbox.stats(),
+        "outbox": await notification_outbox.counts(db),
+        "subscriptions": subscription_batcher.stats(),
+    }
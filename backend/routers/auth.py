@@ -54,10 +54,14 @@ async def register_user(
 @router.get("/users/me", response_model=schemas.UserExternalModel)
 async def get_user(
     current_user: Annotated[
-        models.User, Depends(authentication.get_current_active_user)
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
     ],
+    db: AsyncSession = Depends(get_db),
 ):
-    return schemas.UserExternalModel.model_validate(current_user)
+    # The authenticated user comes without relations, load them for the full model
+    userCRUD = CRUDUser(db)
+    user = await userCRUD.get_one(id=current_user.id, profile="user")
+    return schemas.UserExternalModel.model_validate(user)
 
 
 # 2 Login modes:
@@ -73,9 +77,7 @@ async def login_device(
 ):
     # Get user from database
     userCRUD = CRUDUser(db)
-    user = await userCRUD.get_one(
-        query_dict={"device_id": device_id}, related=["topic_subscriptions"]
-    )
+    user = await userCRUD.get_one(query_dict={"device_id": device_id})
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -90,7 +92,8 @@ async def login_device(
 
     access_token_expires = timedelta(minutes=authentication.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = await authentication.create_access_token(
-        data={"sub": user.device_id}, expires_delta=access_token_expires
+        data=authentication.principal_claims(user),
+        expires_delta=access_token_expires,
     )
     if user.firebase_token != firebase_token:
         user = await userCRUD.update(
@@ -121,6 +124,7 @@ async def login_username(
     # Conver string
     access_token_expires = timedelta(minutes=authentication.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = await authentication.create_access_token(
-        data={"sub": user.device_id}, expires_delta=access_token_expires
+        data=authentication.principal_claims(user),
+        expires_delta=access_token_expires,
     )
     return {"access_token": access_token, "token_type": "bearer", "user_id": user.id}
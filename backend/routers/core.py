@@ -10,9 +10,12 @@ from fastapi import (
     Request,
     Cookie,
     Response,
+    Header,
 )
+from fastapi.responses import StreamingResponse
 
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
 
 from typing import List, Optional, Union, Annotated
 from pydantic import BaseModel
@@ -20,11 +23,14 @@ import uuid
 from enum import Enum
 
 import models, schemas
-from database import get_db
+from config import config
+from database import get_db, get_read_db, get_uow_db
 import authentication
+import audio
 from CRUD.Object import CRUDObject
 from CRUD import Flag, Vote, Answer, Question, User
-from firebase import Firebase
+from notifications import add_notification, new_answers_message
+from experiments import assignment_row, experiment_registry, record_assignments
 
 
 class Message(BaseModel):
@@ -37,6 +43,13 @@ class AnswerSorting(str, Enum):
     unset = "unset"
 
 
+# inline: audio_data is embedded in the response
+# url: only audio_url is returned, the audio is streamed from /answers/{id}/audio
+class AudioMode(str, Enum):
+    inline = "inline"
+    url = "url"
+
+
 def check_list_length(list: List):
     if len(list) == 0:
         raise HTTPException(
@@ -55,10 +68,10 @@ router = APIRouter(
 # Always only question of the day
 @router.get("/question", response_model=schemas.QuestionExternalLimitedModel)
 async def get_question_of_the_day(
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
 ):
     question_CRUD = Question.CRUDQuestion(db, models.Question)
-    question = await question_CRUD.get(query_dict={"of_the_day": True})
+    question = await question_CRUD.get(query_dict={"of_the_day": True}, profile="feed")
 
     if question is None:
         raise HTTPException(
@@ -75,23 +88,29 @@ async def get_question_of_the_day(
 
 @router.get("/answers", response_model=List[schemas.AnswerExternalUserModel])
 async def get_answers(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    request: Request,
     db: AsyncSession = Depends(get_db),
     seen_answers_ids: List[uuid.UUID] = Query(None),
     limit: int = Query(1),
     ids: List[uuid.UUID] = Query(None),
     questions_ids: List[uuid.UUID] = Query(None),
     sorting: AnswerSorting = Query(AnswerSorting.unset),
+    audio_mode: AudioMode = Query(AudioMode.inline),
+    # Exclude the answers the user has already heard, tracked server-side
+    exclude_viewed: bool = Query(False),
 ):
     answers_CRUD = Answer.CRUDAnswer(db, models.Answer)
     question_CRUD = CRUDObject(db, models.Question)
+    with_audio = audio_mode == AudioMode.inline
     kwargs = {}
 
-    if seen_answers_ids is not None:
-        limit += len(seen_answers_ids)
-
     if questions_ids is None:
-        question = await question_CRUD.get(query_dict={"of_the_day": True})
+        question = await question_CRUD.get(
+            query_dict={"of_the_day": True}, profile="feed"
+        )
         if question is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -103,36 +122,70 @@ async def get_answers(
     if ids is not None:
         kwargs["id"] = ids
 
-    answers = []
+    # Select only the answers to return: seen answers and limit are applied in the query,
+    # audio is read and views are recorded for those answers only
+    selection = []
     match sorting:
         case AnswerSorting.random:
-            answers = await answers_CRUD.get_multi_least_viewed(
-                **kwargs, as_pydantic=True
+            selection = await answers_CRUD.get_multi_least_viewed(
+                **kwargs,
+                limit=limit,
+                exclude_ids=seen_answers_ids,
+                exclude_viewed_by=user.id if exclude_viewed else None,
+                as_pydantic=False,
+                with_audio=False,
+                profile="feed",
             )
         case AnswerSorting.top:
-            answers = await answers_CRUD.get_multi_top(**kwargs, as_pydantic=True)
+            selection = await answers_CRUD.get_multi_top(
+                **kwargs,
+                limit=limit,
+                exclude_ids=seen_answers_ids,
+                exclude_viewed_by=user.id if exclude_viewed else None,
+                as_pydantic=False,
+                with_audio=False,
+                profile="feed",
+            )
         case AnswerSorting.unset:
-            answers = await answers_CRUD.get_multi_unset(**kwargs, as_pydantic=True)
-
-    if seen_answers_ids is not None:
-        answers = [answer for answer in answers if answer.id not in seen_answers_ids]
+            selection = await answers_CRUD.get_multi_unset(
+                **kwargs,
+                limit=limit,
+                exclude_ids=seen_answers_ids,
+                exclude_viewed_by=user.id if exclude_viewed else None,
+                as_pydantic=False,
+                with_audio=False,
+                profile="feed",
+            )
 
-    response_answers = []
-    for answer in answers:
-        response_answer = await answers_CRUD.view(answer, user, as_pydantic=True)
-        response_answers.append(response_answer)
+    viewed_answers = [answer for answer, _ in selection]
+    # Record all views in one statement, committed once the response is built
+    views = await answers_CRUD.record_views(
+        user.id, [answer.id for answer in viewed_answers], commit=False
+    )
+    for answer in viewed_answers:
+        if answer.id not in views:
+            continue
+        # Keep the ORM objects in sync without flushing the counters back
+        views_count, unique_views = views[answer.id]
+        set_committed_value(answer, "views_count", views_count)
+        set_committed_value(answer, "unique_views", unique_views)
 
     # Currently returns answers including the user's own answers
     # for answer in response_answers:
     #     if answer.author.id == user.id:
     #         response_answers.remove(answer)
 
-    # Pick only limit'th answers from the front
-    answers = response_answers[:limit]
-
-    # Convert to AnswerExternalUserModel
-    for answer in answers:
-        answer = schemas.AnswerExternalUserModel.model_validate(answer)
+    # Attach the audio last
+    answers = await Answer.add_audio_and_check_pydantic(
+        viewed_answers,
+        as_pydantic=True,
+        with_audio=with_audio,
+        model=schemas.AnswerExternalUserModel,
+    )
+    if not with_audio:
+        for answer in answers:
+            answer.audio_url = get_audio_url(request, answer.id)
+    await db.commit()
 
     check_list_length(answers)
     return answers
@@ -140,27 +193,34 @@ async def get_answers(
 
 @router.post("/answer", response_model=schemas.AnswerExternalModel)
 async def submit_answer(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
     answer: schemas.AnswerCreateModel,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     answers_CRUD = Answer.CRUDAnswer(db, models.Answer)
+    # Notify users subscribed to new answers. The outbox row is committed along with the answer,
+    # new answers within NOTIFICATION_COALESCE_WINDOW seconds are sent as one message,
+    # early once NOTIFICATION_COALESCE_THRESHOLD of them are pending
+    add_notification(
+        db,
+        new_answers_message(),
+        collapse_key="new_answers",
+        delay=config.NOTIFICATION_COALESCE_WINDOW,
+    )
     # CRUD create: return answer, audio_data
     answer = await answers_CRUD.create(answer, as_pydantic=True)
-    # Send notification to all users subscribed to new answers
-    # This could be whole layers of smarter:
-    # 1) Run only on every nth answer
-    # 2) Run only on every nth answer per user
-    firebase = Firebase()
-    firebase_report = await firebase.send_new_answers_notification()
-    print(f"Firebase report: {firebase_report}")
+    await db.commit()
     return answer
 
 
 @router.get("/answers/views", response_model=List[schemas.AnswerExternalViewsModel])
 async def get_answers_views(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
-    db: AsyncSession = Depends(get_db),
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_reader)
+    ],
+    db: AsyncSession = Depends(get_read_db),
     ids: List[uuid.UUID] = Query(None),
 ):
     answers_CRUD = Answer.CRUDAnswer(db, models.Answer)
@@ -171,27 +231,110 @@ async def get_answers_views(
 
 @router.post("/answer/view", response_model=schemas.AnswerExternalModel)
 async def submit_answer_view(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    request: Request,
     answer_id: uuid.UUID,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
+    audio_mode: AudioMode = Query(AudioMode.inline),
 ):
     answers_CRUD = Answer.CRUDAnswer(db, models.Answer)
-    # Get the answer
-    answer = await answers_CRUD.get(id=answer_id)
+    with_audio = audio_mode == AudioMode.inline
+    # Get the answer, columns only as view() loads what the response needs
+    answer = await answers_CRUD.get(
+        id=answer_id, as_pydantic=False, with_audio=False, profile="views"
+    )
     if answer is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Answer not found",
         )
+    answer, _ = answer
     # Increment the view count
-    answer = await answers_CRUD.view(answer, user, as_pydantic=True)
+    answer = await answers_CRUD.view(
+        answer, user, as_pydantic=True, with_audio=with_audio
+    )
+    if not with_audio:
+        answer.audio_url = get_audio_url(request, answer.id)
+    await db.commit()
     return answer
 
 
+def get_audio_url(request: Request, answer_id: uuid.UUID) -> str:
+    return str(request.url_for("get_answer_audio", answer_id=answer_id))
+
+
+# Stream the audio of an answer, supporting Range requests for partial playback
+@router.get(
+    "/answers/{answer_id}/audio",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {"audio/mp4": {}}},
+        206: {"description": "Partial Content"},
+        416: {"description": "Requested Range Not Satisfiable"},
+    },
+)
+async def get_answer_audio(
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    answer_id: uuid.UUID,
+    db: AsyncSession = Depends(get_read_db),
+    range_header: Optional[str] = Header(None, alias="Range"),
+):
+    answers_CRUD = Answer.CRUDAnswer(db, models.Answer)
+    # Columns only, this runs for every Range request of the playback
+    answer = await answers_CRUD.get(
+        id=answer_id, as_pydantic=False, with_audio=False, profile="audio"
+    )
+    if answer is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Answer not found",
+        )
+    answer, _ = answer
+    try:
+        size, media_type = await audio.audio_info(answer.audio_location)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Audio not found",
+        )
+
+    headers = {"Accept-Ranges": "bytes"}
+    try:
+        byte_range = audio.parse_range_header(range_header, size)
+    except audio.RangeNotSatisfiable:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+
+    status_code = status.HTTP_200_OK
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    # A sync iterator is run in the threadpool by StreamingResponse, keeping disk reads off the event loop
+    return StreamingResponse(
+        audio.iter_audio_file(audio.audio_path(answer.audio_location), start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
 # Flag answer
 @router.post("/flag", response_model=schemas.FlagExternalModel)
 async def submit_flag(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
     flag: schemas.FlagCreateModel,
     db: AsyncSession = Depends(get_db),
 ):
@@ -204,9 +347,11 @@ async def submit_flag(
 # Vote answer
 @router.post("/vote", response_model=schemas.VoteExternalModel)
 async def submit_vote(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
     vote: schemas.VoteCreateModel,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_uow_db),
 ):
     votes_CRUD = Vote.CRUDVote(db, models.Vote)
     try:
@@ -217,22 +362,20 @@ async def submit_vote(
                 status_code=status.HTTP_409_CONFLICT,
                 detail="User has already voted on this answer",
             )
-        elif str(e) == "User has already voted on this answer multiple times":
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail="User has already voted on this answer multiple times",
-            )
         else:
             raise e
     vote = schemas.VoteExternalModel.model_validate(vote)
+    await db.commit()
     return vote
 
 
 # Change subscription status for new question notifications
 @router.post("/subscribe/new_question", response_model=schemas.UserExternalModel)
 async def subscribe_new_question(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
-    db: AsyncSession = Depends(get_db),
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    db: AsyncSession = Depends(get_uow_db),
 ):
     user_CRUD = User.CRUDUser(db)
     user = await user_CRUD.change_subscription_status(
@@ -240,13 +383,16 @@ async def subscribe_new_question(
         schemas.TopicSubscription(topic="new_question", subscription_status=True),
     )
     user = schemas.UserExternalModel.model_validate(user)
+    await db.commit()
     return user
 
 
 @router.post("/unsubscribe/new_question", response_model=schemas.UserExternalModel)
 async def unsubscribe_new_question(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
-    db: AsyncSession = Depends(get_db),
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    db: AsyncSession = Depends(get_uow_db),
 ):
     user_CRUD = User.CRUDUser(db)
     user = await user_CRUD.change_subscription_status(
@@ -254,14 +400,17 @@ async def unsubscribe_new_question(
         schemas.TopicSubscription(topic="new_question", subscription_status=False),
     )
     user = schemas.UserExternalModel.model_validate(user)
+    await db.commit()
     return user
 
 
 # Change subscription status for new answers notifications
 @router.post("/subscribe/new_answers", response_model=schemas.UserExternalModel)
 async def subscribe_new_answers(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
-    db: AsyncSession = Depends(get_db),
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    db: AsyncSession = Depends(get_uow_db),
 ):
     user_CRUD = User.CRUDUser(db)
     user = await user_CRUD.change_subscription_status(
@@ -269,13 +418,16 @@ async def subscribe_new_answers(
         schemas.TopicSubscription(topic="new_answers", subscription_status=True),
     )
     user = schemas.UserExternalModel.model_validate(user)
+    await db.commit()
     return user
 
 
 @router.post("/unsubscribe/new_answers", response_model=schemas.UserExternalModel)
 async def unsubscribe_new_answers(
-    user: Annotated[models.User, Depends(authentication.get_current_active_user)],
-    db: AsyncSession = Depends(get_db),
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    db: AsyncSession = Depends(get_uow_db),
 ):
     user_CRUD = User.CRUDUser(db)
     user = await user_CRUD.change_subscription_status(
@@ -283,4 +435,45 @@ async def unsubscribe_new_answers(
         schemas.TopicSubscription(topic="new_answers", subscription_status=False),
     )
     user = schemas.UserExternalModel.model_validate(user)
+    await db.commit()
     return user
+
+
+@router.get("/experiments", response_model=List[schemas.ExperimentAssignmentModel])
+async def get_experiments(
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_reader)
+    ],
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Versions are bucketed from the user id, without querying the user's test groups
+    await experiment_registry.ensure_loaded(db)
+    assignments = experiment_registry.assignments(user.id)
+    return [
+        schemas.ExperimentAssignmentModel(test=test, version=version)
+        for test, version in assignments.items()
+    ]
+
+
+@router.post(
+    "/experiments/{test_name}/exposure",
+    response_model=schemas.ExperimentAssignmentModel,
+)
+async def record_experiment_exposure(
+    user: Annotated[
+        schemas.UserPrincipalModel, Depends(authentication.get_current_active_user)
+    ],
+    test_name: str,
+    db: AsyncSession = Depends(get_uow_db),
+):
+    # The user was shown their version, keep it as a TestGroup for analytics
+    experiment = await experiment_registry.lookup(db, test_name)
+    if experiment is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Test {test_name} not found",
+        )
+    row = assignment_row(experiment, user.id)
+    await record_assignments(db, [row])
+    await db.commit()
+    return schemas.ExperimentAssignmentModel(test=test_name, version=row["version"])
@@ -68,11 +68,12 @@ class UserCreateModel(UserBaseModel):
     username: Optional[str] = Field(None, description="The username of the user")
     password: Optional[str] = Field(None, description="The password of the user")
 
-    # Test group dicts have to take form of {"test": test_name, "version": test_version}
+    # Test group dicts have to take form of {"test": test_name}, the version is bucketed
+    # from the user id and a given "version" is ignored
     test_groups: List[dict[str, str]] = Field(
         None,
-        description="The test groups of the user",
-        example=[{"test": "colour", "version": "red"}],
+        description="The tests the user takes part in",
+        example=[{"test": "colour"}],
     )
 
     @validator("username")
@@ -108,6 +109,32 @@ class UserExternalModel(UserModel):
     pass
 
 
+# Bulk registration from admin perspective, rows that couldn't be registered are reported
+class UserRegistrationConflictModel(BaseModel):
+    index: int = Field(..., description="The position of the user in the request")
+    device_id: Optional[str] = Field(None, description="The device ID of the user")
+    detail: str = Field(..., description="Why the user wasn't registered")
+
+
+class UserBulkRegistrationModel(BaseModel):
+    users: List[UserUpdateAdminModel] = Field(
+        ..., description="The registered users"
+    )
+    conflicts: List[UserRegistrationConflictModel] = Field(
+        ..., description="The users that weren't registered"
+    )
+
+
+# Authenticated user of a request, only what authorization needs
+class UserPrincipalModel(BaseModel):
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+    id: UUID4 = Field(..., description="The ID of the user")
+    device_id: str = Field(..., description="The device ID of the user")
+    username: str = Field(..., description="The username of the user")
+    is_admin: bool = Field(False, description="Whether the user is an admin")
+    is_active: bool = Field(True, description="Whether the user is active")
+
+
 # Question. Needs to handle admin view, user view, other user view, update question info
 
 
@@ -248,13 +275,24 @@ class AnswerUpdateModel(AnswerMinimalModel):
 
 
 # External model, to be returned to the frontend, possibly public
+# Either audio_data or audio_url is set, depending on the requested audio mode
 class AnswerExternalModel(AnswerModel):
-    audio_data: bytes = Field(..., description="The audio data of the answer")
+    audio_data: Optional[bytes] = Field(
+        None, description="The audio data of the answer"
+    )
+    audio_url: Optional[str] = Field(
+        None, description="The URL to stream the audio of the answer from"
+    )
 
 
 # Slightly limited external model for standards users
 class AnswerExternalUserModel(AnswerMinimalModel):
-    audio_data: bytes = Field(..., description="The audio data of the answer")
+    audio_data: Optional[bytes] = Field(
+        None, description="The audio data of the answer"
+    )
+    audio_url: Optional[str] = Field(
+        None, description="The URL to stream the audio of the answer from"
+    )
     question: "QuestionMinimalModel" = Field(
         ..., description="The question of the answer"
     )
@@ -451,6 +489,12 @@ class TestUpdateModel(TestMinimalModel):
     versions: Optional[List[str]] = Field(None, description="The versions of the test")
 
 
+# A user's version of a test, from the experiment registry
+class ExperimentAssignmentModel(BaseModel):
+    test: str = Field(..., description="The name of the test")
+    version: str = Field(..., description="The version of the test of the user")
+
+
 # TestGroup model, for user tests
 class TestGroupBaseModel(BaseModel):
     model_config = ConfigDict(from_attributes=True)
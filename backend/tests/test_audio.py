@@ -0,0 +1,99 @@
+import asyncio
+import uuid
+
+import pytest
+
+import audio
+from audio import (
+    AudioCache,
+    AudioReadStats,
+    RangeNotSatisfiable,
+    parse_range_header,
+    read_audio_batch,
+)
+
+
+@pytest.mark.parametrize(
+    "range_header, expected",
+    [
+        (None, None),
+        ("bytes=0-99", (0, 99)),
+        ("bytes=500-", (500, 999)),
+        ("bytes=0-5000", (0, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-2000", (0, 999)),
+        # Unsupported ranges are served as the whole file
+        ("bytes=-", None),
+        ("bytes=0-1,5-6", None),
+        ("items=0-1", None),
+    ],
+)
+def test_parse_range_header(range_header, expected):
+    assert parse_range_header(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize("range_header", ["bytes=1000-", "bytes=5-2", "bytes=-0"])
+def test_unsatisfiable_ranges(range_header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header(range_header, 1000)
+
+
+def test_cache_evicts_least_recently_used_over_budget():
+    cache = AudioCache(max_bytes=10)
+    first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    cache.put(first, b"1234")
+    cache.put(second, b"1234")
+    # first is now the most recently used
+    assert cache.get(first) == b"1234"
+    cache.put(third, b"1234")
+
+    assert cache.get(second) is None
+    assert cache.get(first) == b"1234"
+    assert cache.get(third) == b"1234"
+    assert cache.size == 8
+    assert cache.evictions == 1
+
+
+def test_cache_skips_files_bigger_than_the_budget():
+    cache = AudioCache(max_bytes=10)
+    kept = uuid.uuid4()
+    cache.put(kept, b"1234")
+    cache.put(uuid.uuid4(), b"12345678901")
+
+    assert cache.get(kept) == b"1234"
+    assert cache.size == 4
+
+
+def test_cache_replacing_and_invalidating_keep_the_size():
+    cache = AudioCache(max_bytes=10)
+    location = uuid.uuid4()
+    cache.put(location, b"1234")
+    cache.put(location, b"123456")
+    assert cache.size == 6
+
+    cache.invalidate(location)
+    assert cache.get(location) is None
+    assert cache.size == 0
+
+
+def test_disabled_cache_keeps_nothing():
+    cache = AudioCache(max_bytes=0)
+    location = uuid.uuid4()
+    cache.put(location, b"1234")
+    assert cache.get(location) is None
+
+
+def test_batch_reads_return_a_miss_for_unreadable_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(audio.config, "AUDIO_FILE_PATH", f"{tmp_path}/")
+    monkeypatch.setattr(audio, "audio_cache", AudioCache(max_bytes=0))
+    stats = AudioReadStats()
+    monkeypatch.setattr(audio, "read_stats", stats)
+    present, missing = uuid.uuid4(), uuid.uuid4()
+    (tmp_path / str(present)).write_bytes(b"audio")
+
+    reads = asyncio.run(read_audio_batch([missing, present]))
+
+    assert [read.audio_data for read in reads] == [None, b"audio"]
+    assert reads[0].error is not None
+    assert stats.stats()["reads"] == 2
+    assert stats.stats()["read_failures"] == 1
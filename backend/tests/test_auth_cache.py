@@ -0,0 +1,81 @@
+import uuid
+
+import auth_cache
+from auth_cache import PrincipalCache
+from schemas import UserPrincipalModel
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def principal(user_id: uuid.UUID = None) -> UserPrincipalModel:
+    return UserPrincipalModel(id=user_id or uuid.uuid4(), device_id="d", username="u")
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth_cache.time, "monotonic", clock)
+    cache = PrincipalCache(ttl=60, max_size=10)
+    user = principal()
+    cache.put("u", user)
+
+    clock.now += 59
+    assert cache.get("u") == user
+    clock.now += 2
+    assert cache.get("u") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_are_dropped_over_max_size():
+    cache = PrincipalCache(ttl=60, max_size=2)
+    cache.put("a", principal())
+    cache.put("b", principal())
+    cache.get("a")
+    cache.put("c", principal())
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_invalidate_drops_every_subject_of_the_user():
+    cache = PrincipalCache(ttl=60, max_size=10)
+    user_id = uuid.uuid4()
+    cache.put("device", principal(user_id))
+    cache.put("username", principal(user_id))
+    cache.put("other", principal())
+
+    cache.invalidate(user_id)
+
+    assert cache.get("device") is None
+    assert cache.get("username") is None
+    assert cache.get("other") is not None
+
+
+def test_invalidate_skips_subjects_cached_for_another_user():
+    # Entries replaced or evicted aren't invalidated with their former user
+    cache = PrincipalCache(ttl=60, max_size=2)
+    user_id = uuid.uuid4()
+    cache.put("device", principal(user_id))
+    cache.put("device", principal())
+    cache.put("username", principal(user_id))
+    cache.put("a", principal())
+    cache.put("b", principal())
+
+    cache.invalidate(user_id)
+
+    assert cache.get("device") is None
+    assert cache.get("a") is not None
+    assert cache.get("b") is not None
+    assert cache._subjects.keys() == {cache.get("a").id, cache.get("b").id}
+
+
+def test_zero_ttl_disables_the_cache():
+    cache = PrincipalCache(ttl=0, max_size=10)
+    cache.put("u", principal())
+    assert cache.get("u") is None
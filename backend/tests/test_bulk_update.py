@@ -0,0 +1,72 @@
+import asyncio
+import uuid
+from collections import namedtuple
+
+from sqlalchemy.dialects import postgresql
+
+import models
+from CRUD import Object
+from CRUD.Object import bulk_update
+
+
+class FakeSession:
+    """
+    Answers each UPDATE ... FROM (VALUES ...) with its rows, in reverse order like Postgres may.
+    """
+
+    def __init__(self, *fields: str):
+        self.Row = namedtuple("Row", ["id", *fields])
+        self.statements = []
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        params = statement.compile(dialect=postgresql.dialect()).params
+        values = [value for name, value in params.items() if name != "updated_at"]
+        size = len(self.Row._fields)
+        rows = [self.Row(*values[i : i + size]) for i in range(0, len(values), size)]
+        return list(reversed(rows))
+
+
+def test_rows_come_back_in_input_order_with_duplicates_merged():
+    db = FakeSession("votes_count")
+    ids = [uuid.uuid4() for _ in range(3)]
+    rows = [
+        {"id": ids[0], "votes_count": 1},
+        {"id": ids[1], "votes_count": 2},
+        {"id": ids[2], "votes_count": 3},
+        {"id": ids[0], "votes_count": 4},
+    ]
+
+    updated = asyncio.run(bulk_update(models.Answer, rows, db))
+
+    assert len(db.statements) == 1
+    assert [(row.id, row.votes_count) for row in updated] == [
+        (ids[0], 4),
+        (ids[1], 2),
+        (ids[2], 3),
+    ]
+
+
+def test_rows_are_chunked_under_the_bind_parameter_limit(monkeypatch):
+    # 2 parameters per row and one for updated_at, so 3 rows per statement
+    monkeypatch.setattr(Object, "MAX_BIND_PARAMS", 7)
+    db = FakeSession("votes_count")
+    rows = [{"id": uuid.uuid4(), "votes_count": n} for n in range(7)]
+
+    updated = asyncio.run(bulk_update(models.Answer, rows, db))
+
+    assert len(db.statements) == 3
+    assert [row.votes_count for row in updated] == list(range(7))
+
+
+def test_rows_are_grouped_by_fields_and_unknown_keys_ignored():
+    db = FakeSession("votes_count")
+    rows = [
+        {"id": uuid.uuid4(), "votes_count": 1},
+        {"id": uuid.uuid4(), "flags_count": 1},
+        {"id": uuid.uuid4(), "not_a_column": 1},
+    ]
+
+    asyncio.run(bulk_update(models.Answer, rows, db))
+
+    assert len(db.statements) == 2
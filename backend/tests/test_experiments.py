@@ -0,0 +1,83 @@
+import asyncio
+import uuid
+
+from experiments import Experiment, ExperimentRegistry, bucket
+
+
+def registry_with(*experiments: Experiment) -> ExperimentRegistry:
+    registry = ExperimentRegistry(refresh_interval=60)
+    registry._experiments = {experiment.name: experiment for experiment in experiments}
+    return registry
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+class FakeSession:
+    """Returns the active tests as refresh() selects them."""
+
+    def __init__(self, *experiments: Experiment):
+        self.experiments = experiments
+        self.executed = 0
+
+    async def execute(self, stmt):
+        self.executed += 1
+        return FakeResult([(e.id, e.name, list(e.versions)) for e in self.experiments])
+
+
+def test_assignments_are_bucketed():
+    user_id = uuid.uuid4()
+    onboarding = Experiment(uuid.uuid4(), "onboarding", ("a", "b"))
+    feed = Experiment(uuid.uuid4(), "feed", ("a", "b", "c"))
+    registry = registry_with(onboarding, feed)
+
+    assert registry.assignments(user_id) == {
+        "onboarding": bucket(user_id, "onboarding", ("a", "b")),
+        "feed": bucket(user_id, "feed", ("a", "b", "c")),
+    }
+
+
+def test_lookup_refreshes_on_a_miss():
+    # A test created on another worker is found before refresh_interval passes
+    onboarding = Experiment(uuid.uuid4(), "onboarding", ("a", "b"))
+    registry = ExperimentRegistry(refresh_interval=60, miss_refresh_interval=0)
+    asyncio.run(registry.refresh(FakeSession()))
+    db = FakeSession(onboarding)
+
+    assert asyncio.run(registry.lookup(db, "onboarding")) == onboarding
+    assert asyncio.run(registry.lookup(db, "onboarding")) == onboarding
+    assert db.executed == 1
+
+
+def test_misses_refresh_at_most_once_per_interval():
+    registry = ExperimentRegistry(refresh_interval=60, miss_refresh_interval=60)
+    db = FakeSession()
+    asyncio.run(registry.refresh(db))
+
+    assert asyncio.run(registry.lookup(db, "unknown")) is None
+    assert asyncio.run(registry.lookup(db, "unknown")) is None
+    assert db.executed == 1
+
+
+def test_bucketing_is_stable_across_processes():
+    # sha256 rather than the per process salted hash()
+    user_id = uuid.UUID("12345678-1234-5678-1234-567812345678")
+    versions = ("a", "b", "c")
+    assert [bucket(user_id, test, versions) for test in ["onboarding", "feed", "player"]] == [
+        "c",
+        "b",
+        "b",
+    ]
+
+
+def test_bucketing_spreads_users_over_versions():
+    versions = ("a", "b")
+    counts = {version: 0 for version in versions}
+    for _ in range(2000):
+        counts[bucket(uuid.uuid4(), "onboarding", versions)] += 1
+    assert all(800 < count < 1200 for count in counts.values())
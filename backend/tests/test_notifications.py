@@ -0,0 +1,114 @@
+import asyncio
+import uuid
+from collections import namedtuple
+
+from sqlalchemy.dialects import postgresql
+
+from notifications import (
+    FakeTransport,
+    NotificationOutbox,
+    add_notification,
+    backoff_delay,
+    new_answers_message,
+)
+from schemas import Message, Notification
+
+# Rows as returned by NotificationOutbox.claim
+Row = namedtuple("Row", ["id", "payload", "collapse_key", "attempts"])
+
+
+def new_row(message: Message, collapse_key: str = None, attempts: int = 1) -> Row:
+    payload = message.model_dump(mode="json", exclude_none=True)
+    return Row(uuid.uuid4(), payload, collapse_key, attempts)
+
+
+def question_message() -> Message:
+    return Message(topic="new_question", notification=Notification(title="t", body="b"))
+
+
+def test_rows_are_sent_once_per_collapse_key():
+    transport = FakeTransport()
+    outbox = NotificationOutbox(transport)
+    rows = [new_row(new_answers_message(), "new_answers") for _ in range(12)]
+    rows += [new_row(question_message()), new_row(question_message())]
+
+    sent_ids, failures = asyncio.run(outbox.deliver(rows))
+
+    assert failures == []
+    assert sorted(sent_ids) == sorted(row.id for row in rows)
+    bodies = sorted(message.notification.body for message in transport.messages)
+    assert bodies == ["12 new answers are now available!", "b", "b"]
+
+
+def test_failed_sends_are_returned_with_their_rows():
+    outbox = NotificationOutbox(FakeTransport(fail=True))
+    rows = [new_row(new_answers_message(), "new_answers") for _ in range(3)]
+
+    sent_ids, failures = asyncio.run(outbox.deliver(rows))
+
+    assert sent_ids == []
+    assert [row for row, _ in failures] == rows
+    assert outbox.stats()["sent"] == 0
+
+
+def test_backoff_doubles_up_to_the_maximum():
+    delays = [backoff_delay(attempts, base=5, maximum=60) for attempts in range(1, 6)]
+    assert delays == [5, 10, 20, 40, 60]
+
+
+class FakeSession:
+    """
+    Records the added objects and executed statements.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.statements = []
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+
+    async def commit(self):
+        pass
+
+
+def test_adding_a_notification_runs_no_statement():
+    db = FakeSession()
+    add_notification(db, new_answers_message(), "new_answers", delay=300)
+    assert len(db.added) == 1
+    assert db.statements == []
+
+
+def test_crowded_collapse_keys_are_released_by_the_worker():
+    db = FakeSession()
+    outbox = NotificationOutbox(FakeTransport(), coalesce_threshold=5)
+
+    asyncio.run(outbox.release_coalesced(db))
+
+    [statement] = db.statements
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+    assert sql.startswith("UPDATE notification_outbox SET next_attempt_at=")
+    assert "HAVING count(*) >= " in sql
+    assert statement.compile().params["count_1"] == 5
+
+
+def test_zero_threshold_never_releases_early():
+    db = FakeSession()
+    outbox = NotificationOutbox(FakeTransport(), coalesce_threshold=0)
+    asyncio.run(outbox.release_coalesced(db))
+    assert db.statements == []
+
+
+def test_failures_on_the_last_attempt_are_dead():
+    db = FakeSession()
+    outbox = NotificationOutbox(FakeTransport(), max_attempts=3)
+    rows = [new_row(question_message(), attempts=2), new_row(question_message(), attempts=3)]
+
+    asyncio.run(outbox.record(db, [], [(row, "error") for row in rows]))
+
+    statuses = [statement.compile().params["status"] for statement in db.statements]
+    assert statuses == ["pending", "dead"]
+    assert "attempts" not in db.statements[0].compile().params
@@ -0,0 +1,137 @@
+import asyncio
+from typing import Dict, List
+
+from firebase_admin import exceptions, messaging
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from firebase import TOPIC_BATCH_SIZE, TopicSubscriptionBatcher
+
+
+class FakeFirebase:
+    """
+    Records topic management calls, failing the tokens in errors with their reason.
+    """
+
+    def __init__(self, errors: Dict[str, str] = None, raises: Exception = None):
+        self.errors = errors or {}
+        self.raises = raises
+        self.calls: List = []
+
+    async def send(self, topic: str, subscribe: bool, tokens: List[str]):
+        self.calls.append((topic, subscribe, tokens))
+        if self.raises is not None:
+            raise self.raises
+        return messaging.TopicManagementResponse(
+            {
+                "results": [
+                    {"error": self.errors[token]} if token in self.errors else {}
+                    for token in tokens
+                ]
+            }
+        )
+
+
+def batcher_with(
+    firebase: FakeFirebase, max_attempts: int = 3
+) -> TopicSubscriptionBatcher:
+    batcher = TopicSubscriptionBatcher(max_attempts=max_attempts)
+    batcher._send = firebase.send
+    return batcher
+
+
+def test_tokens_are_sent_in_batches_of_1000():
+    firebase = FakeFirebase()
+    batcher = batcher_with(firebase)
+
+    async def run():
+        for n in range(2 * TOPIC_BATCH_SIZE + 500):
+            batcher.add("new_answers", f"token-{n}", True)
+        await batcher.flush()
+
+    asyncio.run(run())
+    assert [len(tokens) for _, _, tokens in firebase.calls] == [1000, 1000, 500]
+    assert batcher.stats()["succeeded"] == 2500
+
+
+def test_the_latest_change_of_a_token_wins():
+    firebase = FakeFirebase()
+    batcher = batcher_with(firebase)
+
+    async def run():
+        batcher.add("new_answers", "a", True)
+        batcher.add("new_answers", "b", True)
+        batcher.add("new_answers", "a", False)
+        batcher.add("new_question", "a", True)
+        await batcher.flush()
+
+    asyncio.run(run())
+    assert sorted(firebase.calls) == [
+        ("new_answers", False, ["a"]),
+        ("new_answers", True, ["b"]),
+        ("new_question", True, ["a"]),
+    ]
+
+
+def test_only_transiently_failed_tokens_are_retried():
+    firebase = FakeFirebase(errors={"b": "INTERNAL", "c": "NOT_FOUND"})
+    batcher = batcher_with(firebase)
+
+    async def run():
+        for token in ["a", "b", "c"]:
+            batcher.add("new_answers", token, True)
+        await batcher.flush()
+        firebase.errors = {}
+        await batcher.flush()
+
+    asyncio.run(run())
+    assert firebase.calls == [
+        ("new_answers", True, ["a", "b", "c"]),
+        ("new_answers", True, ["b"]),
+    ]
+    stats = batcher.stats()
+    assert (stats["succeeded"], stats["retried"], stats["dropped"]) == (2, 1, 1)
+
+
+def test_retries_stop_after_max_attempts():
+    firebase = FakeFirebase(errors={"a": "INTERNAL"})
+    batcher = batcher_with(firebase, max_attempts=2)
+
+    async def run():
+        batcher.add("new_answers", "a", True)
+        for _ in range(3):
+            await batcher.flush()
+
+    asyncio.run(run())
+    assert len(firebase.calls) == 2
+    assert batcher.stats()["failed"] == 1
+
+
+def test_failed_calls_are_retried_unless_permanent():
+    transient = batcher_with(FakeFirebase(raises=exceptions.UnavailableError("down")))
+    permanent = batcher_with(FakeFirebase(raises=ValueError("bad token")))
+
+    async def run(batcher: TopicSubscriptionBatcher):
+        batcher.add("new_answers", "a", True)
+        await batcher.flush()
+
+    asyncio.run(run(transient))
+    asyncio.run(run(permanent))
+    assert transient._pending == {("new_answers", True): {"a": 1}}
+    assert permanent._pending == {}
+    assert permanent.stats()["dropped"] == 1
+
+
+def test_changes_are_queued_once_committed():
+    async def run():
+        batcher = TopicSubscriptionBatcher()
+        db = AsyncSession()
+        db.sync_session.begin()
+        batcher.add_after_commit(db, "new_answers", "a", True)
+        await db.rollback()
+        assert batcher._pending == {}
+        db.sync_session.begin()
+        batcher.add_after_commit(db, "new_answers", "b", True)
+        await db.commit()
+        return batcher._pending
+
+    assert asyncio.run(run()) == {("new_answers", True): {"b": 0}}
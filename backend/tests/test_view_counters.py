@@ -0,0 +1,99 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import view_counters
+from view_counters import ViewCounterBuffer
+
+
+def test_increments_are_buffered_once_committed():
+    async def run():
+        buffer = ViewCounterBuffer()
+        db = AsyncSession()
+        answer_id = uuid.uuid4()
+        db.sync_session.begin()
+        buffer.add_after_commit(db, answer_id, 1, 1)
+        assert buffer._pending == {}
+        await db.commit()
+        return buffer._pending, answer_id
+
+    pending, answer_id = asyncio.run(run())
+    assert pending == {answer_id: [1, 1]}
+
+
+def test_increments_are_dropped_on_rollback():
+    async def run():
+        buffer = ViewCounterBuffer()
+        db = AsyncSession()
+        db.sync_session.begin()
+        buffer.add_after_commit(db, uuid.uuid4(), 1, 1)
+        await db.rollback()
+        db.sync_session.begin()
+        await db.commit()
+        return buffer._pending
+
+    assert asyncio.run(run()) == {}
+
+
+class FailingSessionManager:
+    @asynccontextmanager
+    async def session(self):
+        raise ConnectionError("database is down")
+        yield
+
+
+def test_failed_flushes_put_the_increments_back(monkeypatch):
+    monkeypatch.setattr(view_counters, "session_manager", FailingSessionManager())
+
+    async def run():
+        buffer = ViewCounterBuffer()
+        answer_id = uuid.uuid4()
+        buffer.add(answer_id, 2, 1)
+        await buffer.flush()
+        # Views counted while the flush failed are merged with the ones put back
+        buffer.add(answer_id, 1, 0)
+        return buffer, answer_id
+
+    buffer, answer_id = asyncio.run(run())
+    assert buffer._pending == {answer_id: [3, 1]}
+    assert buffer.failed_flushes == 1
+    assert buffer.flushes == 0
+
+
+class RecordingSessionManager:
+    def __init__(self):
+        self.statements = []
+
+    @asynccontextmanager
+    async def session(self):
+        manager = self
+
+        class Session:
+            async def execute(self, statement):
+                manager.statements.append(statement)
+
+            async def commit(self):
+                pass
+
+        yield Session()
+
+
+def test_reaching_max_pending_flushes_before_the_interval(monkeypatch):
+    session_manager = RecordingSessionManager()
+    monkeypatch.setattr(view_counters, "session_manager", session_manager)
+
+    async def run():
+        buffer = ViewCounterBuffer(flush_interval=3600, max_pending=2)
+        buffer.start()
+        buffer.add(uuid.uuid4())
+        buffer.add(uuid.uuid4())
+        for _ in range(10):
+            await asyncio.sleep(0)
+        flushed = buffer.flushed_views
+        await buffer.stop()
+        return flushed
+
+    assert asyncio.run(run()) == 2
+    assert len(session_manager.statements) == 1
@@ -0,0 +1,164 @@
+# Write-behind buffer for Answer view counters
+# Views are coalesced per answer in memory and flushed to the answers table in one statement,
+# so popular answers aren't updated once per listen
+
+import asyncio
+import time
+import uuid
+from typing import Dict, List
+
+from sqlalchemy import Integer, column, event, update, values
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import models
+from config import config
+from database import session_manager
+
+# Session.info key of the increments waiting for the session to commit
+PENDING_INCREMENTS = "view_buffer_pending"
+
+
+class ViewCounterBuffer:
+    def __init__(
+        self,
+        flush_interval: float = config.VIEW_BUFFER_FLUSH_INTERVAL,
+        max_pending: int = config.VIEW_BUFFER_MAX_PENDING,
+    ):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # answer_id -> [views, unique_views] not yet written to the database
+        self._pending: Dict[uuid.UUID, List[int]] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        # Set to have _run flush before the interval is up
+        self._flush_requested = asyncio.Event()
+        # metrics
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flushed_views = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def add(self, answer_id: uuid.UUID, views: int = 1, unique_views: int = 0):
+        counts = self._pending.setdefault(answer_id, [0, 0])
+        counts[0] += views
+        counts[1] += unique_views
+        if len(self._pending) >= self.max_pending:
+            self._flush_requested.set()
+
+    def add_after_commit(
+        self,
+        db: AsyncSession,
+        answer_id: uuid.UUID,
+        views: int = 1,
+        unique_views: int = 0,
+    ):
+        """
+        Adds the increments once db commits the views they count, and drops them if it rolls back,
+        so that the counters stay in line with user_answer_views.
+        """
+        pending = db.info.get(PENDING_INCREMENTS)
+        if pending is None:
+            pending = db.info[PENDING_INCREMENTS] = []
+            event.listen(db.sync_session, "after_commit", self._after_commit)
+            event.listen(db.sync_session, "after_soft_rollback", self._after_rollback)
+        pending.append((answer_id, views, unique_views))
+
+    def _after_commit(self, session: Session):
+        pending = session.info[PENDING_INCREMENTS]
+        for answer_id, views, unique_views in pending:
+            self.add(answer_id, views, unique_views)
+        pending.clear()
+
+    def _after_rollback(self, session: Session, previous_transaction):
+        session.info[PENDING_INCREMENTS].clear()
+
+    async def flush(self):
+        """
+        Writes all pending increments with a single UPDATE ... FROM (VALUES ...).
+        On failure the increments are put back to be retried on the next flush.
+        """
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            start = time.perf_counter()
+            try:
+                async with session_manager.session() as db:
+                    await db.execute(build_increment_statement(pending))
+                    await db.commit()
+            except Exception as e:
+                self.failed_flushes += 1
+                print(f"Flushing view counters failed: {e}")
+                for answer_id, (views, unique_views) in pending.items():
+                    self.add(answer_id, views, unique_views)
+                return
+            latency = time.perf_counter() - start
+            self.flushes += 1
+            self.flushed_views += sum(views for views, _ in pending.values())
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_requested.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending_answers": len(self._pending),
+            "pending_views": sum(views for views, _ in self._pending.values()),
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flushed_views": self.flushed_views,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+
+def build_increment_statement(pending: Dict[uuid.UUID, List[int]]):
+    increments = values(
+        column("id", UUID(as_uuid=True)),
+        column("views", Integer),
+        column("unique_views", Integer),
+        name="increments",
+    ).data([(answer_id, views, unique) for answer_id, (views, unique) in pending.items()])
+    answers = models.Answer.__table__
+    return (
+        update(answers)
+        .where(answers.c.id == increments.c.id)
+        .values(
+            views_count=answers.c.views_count + increments.c.views,
+            unique_views=answers.c.unique_views + increments.c.unique_views,
+        )
+    )
+
+
+view_buffer = ViewCounterBuffer()